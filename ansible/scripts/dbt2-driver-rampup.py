@@ -1,58 +1,471 @@
 # coding: utf-8
 
 import argparse
+import collections
 import datetime
+import json
+import math
+import os
 import psycopg2
-import re
+import shlex
+import signal
+import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import host_stats
+import pg_profiler
 
-def exec_driver(client, duration, warehouse, terminal):
-    notpm = None
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        # Execute the dbt2-driver command
-        cmd = subprocess.run(
-            ['dbt2-driver',
-             '-d', client,
-             '-l', str(duration),
-             '-wmin', '1',
-             '-wmax', str(warehouse),
-             '-w', str(warehouse),
-             '-ktd', '0',
-             '-ktn', '0',
-             '-kto', '0',
-             '-ktp', '0',
-             '-kts', '0',
-             '-ttd', '0',
-             '-ttn', '0',
-             '-tto', '0',
-             '-ttp', '0',
-             '-tts', '0',
-             '-outdir', tmpdirname,
-             '-altered', '1',
-             '-L', str(terminal)],
-             stdout=subprocess.PIPE,
-             stderr=subprocess.PIPE,
-        )
-        if cmd.returncode != 0:
-            raise Exception(cmd.stderr.decode('utf-8'))
-        # Execute the dbt2-post-process command
-        cmd = subprocess.run(
-            ['dbt2-post-process', tmpdirname + '/mix.log'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+
+# TPC-C transaction types, as found in mix.log
+TRANSACTIONS = (
+    ('d', 'delivery'),
+    ('n', 'new_order'),
+    ('o', 'order_status'),
+    ('p', 'payment'),
+    ('s', 'stock_level'),
+)
+LATENCY_PERCENTILES = (50, 90, 99)
+# Share of new-order transactions in the dbt2-driver default mix
+NEW_ORDER_SHARE = 0.45
+# Latency histogram: lowest value, in seconds, and ratio between 2 buckets
+MIN_LATENCY = 0.00001
+LATENCY_PRECISION = 1.01
+
+
+class LatencyHistogram(object):
+    """
+    Log-scaled latency histogram, recording values with a 1% precision
+    """
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        b = int(math.log(max(value, MIN_LATENCY) / MIN_LATENCY,
+                         LATENCY_PRECISION))
+        self.buckets[b] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = self.count * p / 100.0
+        cumul = 0
+        for b in sorted(self.buckets):
+            cumul += self.buckets[b]
+            if cumul >= target:
+                break
+        # Upper bound of the bucket, bounded by the max value
+        return min(MIN_LATENCY * LATENCY_PRECISION ** (b + 1), self.max)
+
+
+class MixLog(object):
+    """
+    Streaming parser of the dbt2-driver mix.log file. Each line contains the
+    time, the transaction type, the response code, the response time and the
+    thread id, a START line marks the beginning of the steady state. Only
+    transactions executed during the steady state are accounted.
+    """
+
+    def __init__(self):
+        self.start = None
+        self.first = None
+        self.end = None
+        self.histograms = dict((t, LatencyHistogram()) for (t, _) in TRANSACTIONS)
+        # Latency histograms of each transaction type, per second
+        self.seconds = {}
+        # Number of new-order transactions per second
+        self.new_orders = collections.Counter()
+        self.errors = 0
+
+    def feed(self, line):
+        fields = line.strip().split(',')
+        if len(fields) < 2:
+            return
+        try:
+            ctime = float(fields[0])
+        except ValueError:
+            return
+        if fields[1] == 'START':
+            # Forget what has been recorded during the rampup
+            self.__init__()
+            self.start = ctime
+            return
+        if len(fields) < 4:
+            return
+        if self.first is None:
+            self.first = ctime
+        self.end = ctime
+        if fields[2] == 'E':
+            self.errors += 1
+            return
+        t = fields[1].lower()
+        if t not in self.histograms:
+            return
+        try:
+            latency = float(fields[3])
+        except ValueError:
+            return
+        self.histograms[t].record(latency)
+        sec = self.seconds.setdefault(int(ctime), {})
+        if t not in sec:
+            sec[t] = LatencyHistogram()
+        sec[t].record(latency)
+        if t == 'n':
+            self.new_orders[int(ctime)] += 1
+
+    def merge(self, other):
+        """
+        Merge the results of another mix.log, recorded at the same time. When
+        the steady states do not start at the same time, the merged steady
+        state starts at the first complete second after the latest START, and
+        the transactions recorded before are removed.
+        """
+        starts = [v for v in (self.start, other.start) if v is not None]
+        for (k, f) in (('start', max), ('first', min), ('end', max)):
+            values = [
+                v for v in (getattr(self, k), getattr(other, k))
+                if v is not None
+            ]
+            setattr(self, k, f(values) if values else None)
+        for (t, h) in other.histograms.items():
+            self.histograms[t].merge(h)
+        for (sec, histograms) in other.seconds.items():
+            mine = self.seconds.setdefault(sec, {})
+            for (t, h) in histograms.items():
+                if t not in mine:
+                    mine[t] = LatencyHistogram()
+                mine[t].merge(h)
+        self.new_orders.update(other.new_orders)
+        self.errors += other.errors
+        if len(set(starts)) > 1:
+            self.trim(math.ceil(self.start))
+
+    def trim(self, start):
+        """
+        Remove the transactions recorded before the second start
+        """
+        self.start = float(start)
+        self.seconds = dict(
+            (sec, h) for (sec, h) in self.seconds.items() if sec >= start
         )
-        if cmd.returncode != 0:
-            raise Exception(cmd.stderr.decode('utf-8'))
+        self.new_orders = collections.Counter(dict(
+            (sec, n) for (sec, n) in self.new_orders.items() if sec >= start
+        ))
+        self.histograms = dict((t, LatencyHistogram()) for (t, _) in TRANSACTIONS)
+        for histograms in self.seconds.values():
+            for (t, h) in histograms.items():
+                self.histograms[t].merge(h)
+
+    def duration(self):
+        """
+        Duration of the steady state, in seconds
+        """
+        start = self.start if self.start is not None else self.first
+        if start is None or self.end is None:
+            return 0
+        return self.end - start
+
+    def notpm(self):
+        """
+        New-order transactions per minute
+        """
+        if self.duration() <= 0:
+            return None
+        return self.histograms['n'].count / (self.duration() / 60.0)
+
+    def throughput(self):
+        """
+        Returns the list of (second, new-order transactions per minute) of the
+        complete seconds of the steady state
+        """
+        start = self.start if self.start is not None else self.first
+        if start is None or self.end is None:
+            return []
+        return [
+            (sec, self.new_orders[sec] * 60.0)
+            for sec in range(int(start) + 1, int(self.end))
+        ]
+
+    def mean_latency(self):
+        """
+        Mean response time, in seconds, of all the transactions
+        """
+        count = sum(h.count for h in self.histograms.values())
+        if count == 0:
+            return None
+        return sum(h.sum for h in self.histograms.values()) / count
+
+    def latencies(self):
+        """
+        Returns the latency percentiles and max, in seconds, of each
+        transaction type
+        """
+        data = {}
+        for (t, name) in TRANSACTIONS:
+            h = self.histograms[t]
+            for p in LATENCY_PERCENTILES:
+                data['%s_p%s' % (name, p)] = h.percentile(p)
+            data['%s_max' % name] = h.max if h.count else None
+        return data
+
+
+def is_steady(mix_log, min_duration, window, interval, max_cv):
+    """
+    Returns True when the throughput is stable: the coefficient of variation of
+    the number of new-order transactions per interval, over the last window
+    seconds of the steady state, is lower than max_cv. The minimum duration
+    must have elapsed.
+    """
+    if mix_log.duration() < max(min_duration, window):
+        return False
+    # The current second is not complete yet
+    last = int(mix_log.end)
+    counts = [
+        sum(mix_log.new_orders[s] for s in range(b, b + interval))
+        for b in range(last - window, last - interval + 1, interval)
+    ]
+    if len(counts) < 2:
+        return False
+    mean = statistics.mean(counts)
+    if mean == 0:
+        return False
+    return statistics.pstdev(counts) / mean < max_cv
+
+
+def follow(path, process, mix_log, poll=0.5, stop=None):
+    """
+    Parse the mix.log file while it's being written by the process. The
+    process is terminated as soon as stop(mix_log) returns True.
+    """
+    f = None
+    buf = ''
+    stopped = False
+    while True:
+        running = process.poll() is None
+        if running and not stopped and stop is not None and stop(mix_log):
+            process.terminate()
+            stopped = True
+        data = ''
+        if f is None and os.path.exists(path):
+            f = open(path, 'r')
+        if f is not None:
+            data = f.read()
+            lines = (buf + data).split('\n')
+            # Last line could be incomplete
+            buf = lines.pop()
+            for line in lines:
+                mix_log.feed(line)
+        if not running:
+            break
+        if not data:
+            time.sleep(poll)
+    if f is not None:
+        f.close()
+    if buf:
+        mix_log.feed(buf)
+    return stopped
+
+
+def driver_args(client, duration, warehouse, wmin, wmax, terminal, outdir,
+                think_time=0):
+    """
+    Returns the dbt2-driver command line. Keying times are set to 0 and the
+    thinking times, in milliseconds, to think_time: with a thinking time of 0,
+    each terminal executes its transactions back to back.
+    """
+    think_time = str(int(think_time))
+    return [
+        'dbt2-driver',
+        '-d', client,
+        '-l', str(duration),
+        '-wmin', str(wmin),
+        '-wmax', str(wmax),
+        '-w', str(warehouse),
+        '-ktd', '0',
+        '-ktn', '0',
+        '-kto', '0',
+        '-ktp', '0',
+        '-kts', '0',
+        '-ttd', think_time,
+        '-ttn', think_time,
+        '-tto', think_time,
+        '-ttp', think_time,
+        '-tts', think_time,
+        '-outdir', outdir,
+        '-altered', '1',
+        '-L', str(terminal),
+    ]
+
+
+def exec_driver(client, duration, warehouse, terminal, stop=None,
+                think_time=0):
+    """
+    Execute dbt2-driver for duration seconds and return the parsed mix.log.
+    The driver is stopped earlier if stop(mix_log) returns True.
+    """
+    mix_log = MixLog()
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        # Execute the dbt2-driver command, mix.log is parsed on the fly
+        with open(os.path.join(tmpdirname, 'stderr'), 'w+') as stderr:
+            p = subprocess.Popen(
+                driver_args(
+                    client, duration, warehouse, 1, warehouse, terminal,
+                    tmpdirname, think_time
+                ),
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+            )
+            stopped = follow(
+                os.path.join(tmpdirname, 'mix.log'), p, mix_log, stop=stop
+            )
+            if p.returncode != 0 and not stopped:
+                stderr.seek(0)
+                raise Exception(stderr.read())
+    return mix_log
+
 
-        for line in cmd.stdout.splitlines():
-            m = re.search(r'^([0-9.]*) new-order transactions per minute', line.decode('utf-8'))
-            if m:
-                notpm = m.group(1)
-    return notpm
+# Shell script executing dbt2-driver on a driver host, once the start time is
+# reached. mix.log is streamed on the standard output and the driver is killed
+# if the output is closed.
+REMOTE_DRIVER = """\
+D=$(mktemp -d) || exit 1
+sleep $(awk "BEGIN {d = %(start)f - $(date +%%s.%%N); print (d > 0) ? d : 0}")
+%(driver)s > $D/driver.log 2>&1 &
+pid=$!
+tail -n +1 -s 0.5 -F --pid=$pid $D/mix.log 2> /dev/null
+kill $pid 2> /dev/null
+wait $pid
+rc=$?
+[ $rc -ne 0 ] && cat $D/driver.log >&2
+rm -rf $D
+exit $rc
+"""
+
+
+def start_driver(host, start, args):
+    """
+    Start dbt2-driver on a driver host, through SSH, or locally when the host
+    is 'local', at the start time. args are the dbt2-driver arguments, '$D'
+    standing for the output directory. mix.log is streamed on the standard
+    output of the returned process, the driver output is kept in a temporary
+    file set as its stderr attribute.
+    """
+    script = REMOTE_DRIVER % {
+        'start': start,
+        'driver': ' '.join(
+            [shlex.quote(a) for a in args]
+        ).replace("'$D'", '$D'),
+    }
+    if host == 'local':
+        cmd = ['sh', '-c', script]
+    else:
+        cmd = ['ssh', host, script]
+    stderr = tempfile.TemporaryFile(mode='w+')
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        universal_newlines=True,
+        start_new_session=True,
+    )
+    p.stderr = stderr
+    return p
+# Delay given to the driver hosts to reach the start barrier
+BARRIER_DELAY = 5
+
+
+def split(n, parts):
+    """
+    Split n in parts, returns the list of (first, count)
+    """
+    ranges = []
+    first = 1
+    for i in range(parts):
+        count = n // parts + (1 if i < n % parts else 0)
+        ranges.append((first, count))
+        first += count
+    return ranges
+
+
+def exec_drivers(hosts, client, duration, warehouse, terminal, stop=None,
+                 think_time=0):
+    """
+    Execute dbt2-driver concurrently on several driver hosts, through SSH, and
+    return the merged mix.log. Warehouses and terminals are split between the
+    hosts, all the drivers start at the same time. The special host name
+    'local' executes the driver locally. The drivers are stopped earlier if
+    stop(mix_log) returns True.
+    """
+    start = time.time() + BARRIER_DELAY
+    drivers = []
+    # Each host used gets at least one terminal and one warehouse
+    hosts = hosts[:min(len(hosts), terminal, warehouse)]
+    for (host, (wmin, wcount), (_, tcount)) in zip(
+            hosts, split(warehouse, len(hosts)), split(terminal, len(hosts))):
+        p = start_driver(host, start, driver_args(
+            client, duration, warehouse, wmin, wmin + wcount - 1, tcount,
+            '$D', think_time
+        ))
+        drivers.append((host, p, MixLog(), threading.Lock()))
+
+    def read(p, mix_log, lock):
+        for line in p.stdout:
+            with lock:
+                mix_log.feed(line)
+
+    threads = [
+        threading.Thread(target=read, args=(p, m, l))
+        for (_, p, m, l) in drivers
+    ]
+    for t in threads:
+        t.start()
+
+    def merged():
+        mix_log = MixLog()
+        for (_, _, m, l) in drivers:
+            with l:
+                mix_log.merge(m)
+        return mix_log
+
+    stopped = False
+    while any(p.poll() is None for (_, p, _, _) in drivers):
+        if not stopped and stop is not None and stop(merged()):
+            for (_, p, _, _) in drivers:
+                if p.poll() is None:
+                    os.killpg(p.pid, signal.SIGTERM)
+            stopped = True
+        time.sleep(0.5)
+    for t in threads:
+        t.join()
+
+    errors = []
+    for (host, p, _, _) in drivers:
+        if p.returncode != 0 and not stopped:
+            p.stderr.seek(0)
+            errors.append("dbt2-driver failed on %s: %s"
+                          % (host, p.stderr.read()))
+        p.stdout.close()
+        p.stderr.close()
+    if errors:
+        raise Exception('\n'.join(errors))
+    return merged()
 
 
 def start_dbt2_client(client, proxy, dbname, port, connections):
@@ -91,7 +504,807 @@ def catchup_time(conn):
     return records
 
 
-if __name__ == '__main__':
+class LagSampler(threading.Thread):
+    """
+    Samples, in the background, the replication lag of each peer node: lag in
+    bytes and replay lag in seconds.
+    """
+
+    def __init__(self, dsn, interval):
+        super(LagSampler, self).__init__()
+        self.daemon = True
+        self.dsn = dsn
+        self.interval = interval
+        # List of (time, node name, lag in bytes, lag in seconds)
+        self.samples = []
+        self.error = None
+        self.stopping = threading.Event()
+
+    def run(self):
+        try:
+            conn = psycopg2.connect(self.dsn)
+            conn.set_session(autocommit=True)
+        except psycopg2.Error as e:
+            self.error = e
+            return
+        deadline = time.monotonic()
+        try:
+            while not self.stopping.is_set():
+                cur = conn.cursor()
+                cur.execute("""
+                SELECT target_name, replay_lag_bytes,
+                       EXTRACT(epoch FROM replay_lag)
+                FROM bdr.node_slots
+                WHERE origin_name <> '' AND slot_type = 'logical'
+                """)
+                t = time.time()
+                for r in cur.fetchall():
+                    if r[0].startswith('witness'):
+                        # Just ignore what's going on with the witness node
+                        continue
+                    # No replay lag is reported when the peer is idle
+                    self.samples.append(
+                        (t, r[0], r[1] or 0, float(r[2] or 0))
+                    )
+                cur.close()
+                deadline += self.interval
+                self.stopping.wait(max(0, deadline - time.monotonic()))
+        except psycopg2.Error as e:
+            self.error = e
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write("timestamp,node,lag_bytes,lag_time\n")
+            for (t, node_name, lag_bytes, lag_time) in self.samples:
+                f.write("%s,%s,%d,%f\n" % (
+                    datetime.datetime.utcfromtimestamp(t).isoformat(),
+                    node_name, lag_bytes, lag_time
+                ))
+
+
+def slope(points):
+    """
+    Least squares slope of a list of (x, y)
+    """
+    n = len(points)
+    if n < 2:
+        return 0.0
+    mx = sum(x for (x, _) in points) / n
+    my = sum(y for (_, y) in points) / n
+    sxx = sum((x - mx) ** 2 for (x, _) in points)
+    if sxx == 0:
+        return 0.0
+    return sum((x - mx) * (y - my) for (x, y) in points) / sxx
+
+
+# Statistics of the lag time series of each node
+LAG_SERIES_STATS = (
+    'peak_lag_bytes', 'mean_lag_bytes', 'lag_slope', 'peak_lag_time',
+    'mean_lag_time', 'lag_time_slope', 'series_notpm',
+)
+
+
+def lag_series_stats(samples, notpm, slope_window):
+    """
+    Returns, for each node, statistics of its lag time series: peak and mean
+    lag, in bytes and in seconds, lag growth in bytes/s and in s/s over the
+    last slope_window seconds, and the sustainable NOTPM computed from them.
+
+    A node whose replay lag still grows by r seconds per second at the end of
+    the step applies changes (1 - r) times as fast as they are produced. Like
+    for the catchup time, a backlog of L seconds left over a step of d
+    seconds brings the sustainable NOTPM down to notpm * d / (d + L). The
+    backlog is the largest of the mean lag, carried during the whole step,
+    the lag at the end of the step, from the end of step trend, and the peak
+    lag while the node has not started to recover from it. The sustainable
+    NOTPM is the lowest of both estimates.
+    """
+    stats = {}
+    for node_name in sorted(set(s[1] for s in samples)):
+        series = [s for s in samples if s[1] == node_name]
+        end = series[-1][0]
+        duration = end - series[0][0]
+        tail = [s for s in series if s[0] >= end - slope_window]
+        peak_lag_time = max(s[3] for s in series)
+        mean_lag_time = sum(s[3] for s in series) / len(series)
+        growth = slope([(t, lag_time) for (t, _, _, lag_time) in tail])
+        # Lag at the end of the step, on the end of step trend line
+        end_lag_time = max(
+            sum(s[3] for s in tail) / len(tail)
+            + growth * (end - sum(s[0] for s in tail) / len(tail)),
+            0.0
+        )
+        backlog = max(
+            mean_lag_time, end_lag_time,
+            peak_lag_time if growth > 0 else 0.0
+        )
+        rate = 1 - min(max(growth, 0.0), 1.0)
+        if duration > 0:
+            rate = min(rate, duration / (duration + backlog))
+        stats[node_name] = {
+            'peak_lag_bytes': max(s[2] for s in series),
+            'mean_lag_bytes': sum(s[2] for s in series) / len(series),
+            'lag_slope': slope([
+                (t, lag_bytes) for (t, _, lag_bytes, _) in tail
+            ]),
+            'peak_lag_time': peak_lag_time,
+            'mean_lag_time': mean_lag_time,
+            'lag_time_slope': growth,
+            'series_notpm': notpm * rate,
+        }
+    return stats
+
+
+def bdr_nodes(conn):
+    """
+    Returns the list of (node_name, connection string) of the active BDR data
+    nodes
+    """
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT node_name, interface_connstr
+    FROM bdr.node_summary
+    WHERE peer_state_name = 'ACTIVE' AND node_kind_name <> 'witness'
+    ORDER BY node_name
+    """)
+    nodes = [(r[0], r[1]) for r in cur.fetchall()]
+    cur.close()
+    return nodes
+
+
+def timed(f, *args):
+    """
+    Returns the duration, in seconds, of the execution of f(*args)
+    """
+    start = time.monotonic()
+    f(*args)
+    return time.monotonic() - start
+
+
+def node_checkpoint(conn):
+    cur = conn.cursor()
+    cur.execute("CHECKPOINT")
+    cur.close()
+
+
+def wait_for_drain(conn, poll, timeout):
+    """
+    Wait until the replication lag of all the peers of a node is zero
+    """
+    start = time.monotonic()
+    cur = conn.cursor()
+    while True:
+        cur.execute("""
+        SELECT COALESCE(MAX(replay_lag_bytes), 0)
+        FROM bdr.node_slots
+        WHERE origin_name <> '' AND slot_type = 'logical'
+          AND target_name NOT LIKE 'witness%'
+        """)
+        if cur.fetchone()[0] <= 0:
+            break
+        if time.monotonic() - start > timeout:
+            cur.close()
+            raise Exception("Replication lag not drained after %ss" % timeout)
+        time.sleep(poll)
+    cur.close()
+
+
+class Quiesce(object):
+    """
+    Barrier between 2 steps: waits for the replication lag of all the nodes
+    to be drained, then executes a checkpoint on all the nodes concurrently.
+    """
+
+    def __init__(self, conn, poll, timeout):
+        self.nodes = bdr_nodes(conn)
+        self.poll = poll
+        self.timeout = timeout
+
+    def __call__(self, step_end):
+        """
+        Returns the drain time, since the end of the step, and the checkpoint
+        duration of each node
+        """
+        conns = []
+        try:
+            for (node_name, dsn) in self.nodes:
+                conn = psycopg2.connect(dsn)
+                conn.set_session(autocommit=True)
+                conns.append((node_name, conn))
+            with ThreadPoolExecutor(max_workers=len(conns)) as executor:
+                futures = [
+                    executor.submit(
+                        wait_for_drain, conn, self.poll, self.timeout
+                    )
+                    for (_, conn) in conns
+                ]
+                for f in futures:
+                    f.result()
+                drain_time = time.monotonic() - step_end
+                futures = [
+                    (node_name, executor.submit(timed, node_checkpoint, conn))
+                    for (node_name, conn) in conns
+                ]
+                checkpoint_times = [(n, f.result()) for (n, f) in futures]
+        finally:
+            for (_, conn) in conns:
+                conn.close()
+        return (drain_time, checkpoint_times)
+
+
+def run_drivers(env, duration, terminal, stop=None, think_time=0):
+    """
+    Execute dbt2-driver locally, or on the driver hosts
+    """
+    if env.driver_hosts:
+        return exec_drivers(
+            env.driver_hosts, env.client, duration, env.warehouse, terminal,
+            stop=stop, think_time=think_time
+        )
+    return exec_driver(
+        env.client, duration, env.warehouse, terminal, stop=stop,
+        think_time=think_time
+    )
+
+
+def open_loop(target_notpm, terminal_rate, response_time):
+    """
+    Returns the number of terminals and the thinking time, in milliseconds,
+    offering target_notpm new-order transactions per minute. Each terminal
+    executes terminal_rate transactions per second: one transaction every
+    1/terminal_rate seconds, response time included. The thinking time must
+    remain larger than the response time, so the offered load does not depend
+    on it.
+    """
+    # Transactions per second, all types
+    rate = target_notpm / NEW_ORDER_SHARE / 60.0
+    cycle = max(1.0 / terminal_rate, 2 * response_time)
+    terminals = max(1, int(math.ceil(rate * cycle)))
+    think_time = terminals / rate - response_time
+    return (terminals, think_time * 1000)
+
+
+def parse_schedule(value):
+    """
+    Parse the target NOTPM schedule: comma separated NOTPM values, or
+    percentages of the maximum NOTPM
+    """
+    schedule = []
+    for v in value.split(','):
+        v = v.strip()
+        try:
+            if v.endswith('%'):
+                schedule.append((float(v[:-1]), True))
+            else:
+                schedule.append((float(v), False))
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid target: %s" % v)
+    return schedule
+
+
+# Load shapes and their parameters, with default values
+LOAD_SHAPES = {
+    'constant': {'notpm': None},
+    'spike': {'base': None, 'peak': None, 'start': 60, 'length': 30},
+    'square': {'low': None, 'high': None, 'period': 120},
+    'sine': {'mean': None, 'amplitude': None, 'period': 86400, 'phase': 0},
+    'replay': {'file': None, 'scale': 1, 'speed': 1},
+}
+
+
+# Lag recovery: ratio of the peak lag
+RECOVERED_LAG = 0.1
+# Number of load unit failures after which the load profile is aborted
+MAX_UNIT_FAILURES = 5
+
+
+def parse_load_profile(value):
+    """
+    Parse a load profile: shape:param=value,... Returns (shape, params)
+    """
+    (shape, _, args) = value.partition(':')
+    if shape not in LOAD_SHAPES:
+        raise argparse.ArgumentTypeError("unknown load shape: %s" % shape)
+    params = dict(LOAD_SHAPES[shape])
+    for arg in [a for a in args.split(',') if a]:
+        (k, _, v) = arg.partition('=')
+        if k not in params:
+            raise argparse.ArgumentTypeError(
+                "unknown %s parameter: %s" % (shape, k)
+            )
+        try:
+            params[k] = v if k == 'file' else float(v)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid value: %s" % arg)
+    missing = [k for (k, v) in params.items() if v is None]
+    if missing:
+        raise argparse.ArgumentTypeError(
+            "missing %s parameters: %s" % (shape, ', '.join(missing))
+        )
+    return (shape, params)
+
+
+def read_curve(path):
+    """
+    Read a load curve: CSV lines of time in seconds and NOTPM
+    """
+    points = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split(',')
+            try:
+                points.append((float(fields[0]), float(fields[1])))
+            except (IndexError, ValueError):
+                # Headers or comments
+                continue
+    if not points:
+        raise Exception("No load found in %s" % path)
+    return sorted(points)
+
+
+def load_shape(shape, params):
+    """
+    Returns the function giving the target NOTPM at t seconds
+    """
+    p = params
+    if shape == 'constant':
+        return lambda t: p['notpm']
+    if shape == 'spike':
+        return lambda t: (
+            p['peak'] if p['start'] <= t < p['start'] + p['length']
+            else p['base']
+        )
+    if shape == 'square':
+        return lambda t: (
+            p['high'] if (t % p['period']) >= p['period'] / 2 else p['low']
+        )
+    if shape == 'sine':
+        return lambda t: max(0, p['mean'] + p['amplitude'] * math.sin(
+            2 * math.pi * (t + p['phase']) / p['period']
+        ))
+    # Replayed curve, linear interpolation between the points
+    points = read_curve(p['file'])
+
+    def replay(t):
+        t = t * p['speed'] + points[0][0]
+        if t <= points[0][0]:
+            return points[0][1] * p['scale']
+        for ((t0, v0), (t1, v1)) in zip(points, points[1:]):
+            if t0 <= t < t1:
+                return (v0 + (v1 - v0) * (t - t0) / (t1 - t0)) * p['scale']
+        return points[-1][1] * p['scale']
+    return replay
+
+
+class LoadUnits(object):
+    """
+    The applied load is made of units: dbt2-driver processes offering the
+    same load, started and stopped to follow the target. The units are spread
+    over the driver hosts, mix.log is streamed and the new-order transactions
+    of all the units are counted per second. Units exiting unexpectedly are
+    reported and replaced, up to MAX_UNIT_FAILURES times.
+    """
+
+    def __init__(self, env, terminal, think_time):
+        self.env = env
+        self.terminal = terminal
+        self.think_time = think_time
+        self.hosts = env.driver_hosts or ['local']
+        self.units = []
+        self.started = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        # Number of new-order transactions per second
+        self.new_orders = collections.Counter()
+
+    def read(self, p):
+        for line in p.stdout:
+            fields = line.split(',')
+            if len(fields) < 4 or fields[1].lower() != 'n' \
+                    or fields[2] == 'E':
+                continue
+            try:
+                sec = int(float(fields[0]))
+            except ValueError:
+                continue
+            with self.lock:
+                self.new_orders[sec] += 1
+
+    def start_unit(self):
+        host = self.hosts[self.started % len(self.hosts)]
+        self.started += 1
+        p = start_driver(host, time.time(), driver_args(
+            self.env.client, self.env.duration + 3600, self.env.warehouse, 1,
+            self.env.warehouse, self.terminal, '$D', self.think_time
+        ))
+        t = threading.Thread(target=self.read, args=(p,))
+        t.daemon = True
+        t.start()
+        self.units.append((host, p, t))
+
+    def close_unit(self, unit):
+        (_, p, t) = unit
+        t.join()
+        p.stdout.close()
+        p.stderr.close()
+
+    def stop_unit(self):
+        unit = self.units.pop()
+        p = unit[1]
+        if p.poll() is None:
+            os.killpg(p.pid, signal.SIGTERM)
+        p.wait()
+        self.close_unit(unit)
+
+    def resize(self, n):
+        # Dead units are reported and replaced
+        for unit in [u for u in self.units if u[1].poll() is not None]:
+            (host, p, _) = unit
+            self.units.remove(unit)
+            p.stderr.seek(0)
+            print("WARNING: dbt2-driver exited with code %d on %s: %s"
+                  % (p.returncode, host, p.stderr.read().strip()),
+                  file=sys.stderr)
+            self.close_unit(unit)
+            self.failures += 1
+        if n > 0 and self.failures >= MAX_UNIT_FAILURES:
+            raise Exception("Load profile aborted: %d dbt2-driver failures"
+                            % self.failures)
+        while len(self.units) < n:
+            self.start_unit()
+        while len(self.units) > n:
+            self.stop_unit()
+
+    def applied(self, sec):
+        """
+        NOTPM applied during the given second
+        """
+        with self.lock:
+            return self.new_orders.get(sec, 0) * 60
+
+
+def run_load_profile(env, shape, params, out):
+    """
+    Apply the load profile for env.duration seconds, the number of units is
+    adjusted every second. Writes, for each second, the target and applied
+    NOTPM and the replication lag of each node.
+    """
+    target = load_shape(shape, params)
+    (terminal, think_time) = open_loop(env.unit_notpm, env.terminal_rate, 0)
+    units = LoadUnits(env, terminal, think_time)
+    sampler = LagSampler(env.pg, env.lag_interval)
+    sampler.start()
+    timeline = []
+    start = time.time()
+    try:
+        for i in range(int(env.duration)):
+            notpm = target(i)
+            n = int(round(notpm / env.unit_notpm))
+            units.resize(n)
+            timeline.append((int(start) + i, notpm, n))
+            time.sleep(max(0, start + i + 1 - time.time()))
+        # Last transactions
+        time.sleep(1)
+    finally:
+        units.resize(0)
+        sampler.stop()
+    if sampler.error is not None:
+        raise Exception("Unable to sample the replication lag: %s"
+                        % sampler.error)
+
+    # Last lag samples of each node, per second
+    lags = {}
+    for (t, node_name, lag_bytes, lag_time) in sampler.samples:
+        lags.setdefault(int(t), {})[node_name] = (lag_bytes, lag_time)
+    nodes = sorted(set(n for s in lags.values() for n in s))
+    header = ['timestamp', 'target_notpm', 'units', 'applied_notpm']
+    for node_name in nodes:
+        header += ['%s_lag_bytes' % node_name, '%s_lag_time' % node_name]
+    out.write("%s\n" % ','.join(header))
+    last = {}
+    for (sec, notpm, n) in timeline:
+        last.update(lags.get(sec, {}))
+        line = [
+            datetime.datetime.utcfromtimestamp(sec).isoformat(),
+            "%.2f" % notpm, str(n), str(units.applied(sec)),
+        ]
+        for node_name in nodes:
+            (lag_bytes, lag_time) = last.get(node_name, ('', ''))
+            line += [str(lag_bytes), str(lag_time)]
+        out.write("%s\n" % ','.join(line))
+    out.flush()
+
+    # Lag peak of each node, and time needed to recover from it
+    applied = sum(units.applied(sec) for (sec, _, _) in timeline)
+    offered = sum(notpm for (_, notpm, _) in timeline)
+    if offered > 0:
+        print("Applied load: %.1f%% of the target" % (100.0 * applied / offered),
+              file=sys.stderr)
+    for node_name in nodes:
+        series = [
+            (t, lag_bytes) for (t, n, lag_bytes, _) in sampler.samples
+            if n == node_name
+        ]
+        (peak_time, peak) = max(series, key=lambda x: x[1])
+        recovered = [
+            t for (t, lag_bytes) in series
+            if t > peak_time and lag_bytes <= peak * RECOVERED_LAG
+        ]
+        print("%s: peak lag %d bytes at +%.0fs, recovered %s" % (
+            node_name, peak, peak_time - start,
+            "after %.0fs" % (recovered[0] - peak_time) if recovered
+            else "never"
+        ), file=sys.stderr)
+
+
+def run_step(env, conn, terminal, quiesce=None, agents=(), profiler=None,
+             target_notpm=None, think_time=0):
+    """
+    Execute one rampup step with the given number of terminals and return its
+    results. In open loop mode, target_notpm is the offered load and
+    think_time the thinking time of the terminals, in milliseconds.
+    """
+    if quiesce is None:
+        # Execute a checkpoint
+        checkpoint(conn)
+    # Sample the replication lag during the whole step
+    sampler = LagSampler(env.pg, env.lag_interval)
+    sampler.start()
+    if profiler is not None:
+        profiler.start()
+    step_start = time.monotonic()
+    # Execute dbt2-driver
+    try:
+        if env.steady_state:
+            # The step lasts until the throughput is stable, between the
+            # minimum and maximum durations
+            mix_log = run_drivers(
+                env, env.max_duration, terminal,
+                stop=lambda m: is_steady(
+                    m, env.min_duration, env.steady_window,
+                    env.steady_interval, env.steady_cv
+                ),
+                think_time=think_time
+            )
+            duration = mix_log.duration()
+        else:
+            mix_log = run_drivers(
+                env, env.duration, terminal, think_time=think_time
+            )
+            duration = env.duration
+    finally:
+        sampler.stop()
+        if profiler is not None:
+            profile = profiler.stop(terminal)
+    step_end = time.monotonic()
+    timestamp = datetime.datetime.utcnow().isoformat()
+    if mix_log.notpm() is None:
+        raise Exception("No transaction found in mix.log")
+    notpm = "%.2f" % mix_log.notpm()
+
+    data = {}
+    data['timestamp'] = timestamp
+    data['terminals'] = terminal
+    data['notpm'] = notpm
+    # Lowest sustainable NOTPM of all the nodes, from the catchup time or from
+    # the lag time series, depending on the objective
+    data['objective'] = env.objective
+    data['sustainable_notpm'] = ''
+    if env.steady_state:
+        data['duration'] = "%.1f" % duration
+    if target_notpm is not None:
+        # Offered vs achieved load
+        data['target_notpm'] = "%.2f" % target_notpm
+        data['achieved_pct'] = "%.1f" % (100.0 * mix_log.notpm() / target_notpm)
+        data['think_time'] = "%.1f" % think_time
+        data['mean_response_time'] = "%.6f" % (mix_log.mean_latency() or 0)
+
+    # Get catchup time
+    for (c_slot_name, c_time) in catchup_time(conn):
+        node_name = c_slot_name.replace('bdr_edb_bdrdb_group_', '')
+
+        if node_name.startswith('witness'):
+            # Just ignore what's going on with the witness node
+            continue
+
+        data['%s_catchup_time' % node_name] = c_time
+        # Calculate sustainable rate
+        sustainable_rate = (float(notpm)*(float(duration)/60))/(float(duration) + float(c_time)) * 60
+        data['%s_sustainable_notpm' % node_name] = sustainable_rate
+
+    # Host resource usage during the step
+    for agent in agents:
+        if agent.error is not None:
+            print("WARNING: telemetry agent on %s died, %s"
+                  % (agent.host, agent.error), file=sys.stderr)
+        metrics = agent.window(step_start, step_end)
+        for m in host_stats.METRICS:
+            data['%s_%s' % (agent.host, m)] = \
+                "%.2f" % metrics[m] if m in metrics else ''
+
+    # Bottleneck summary
+    if profiler is not None:
+        data.update(profile)
+
+    if quiesce is not None:
+        # Wait for all the nodes to be drained, then checkpoint them: the
+        # next step starts on a quiet cluster
+        (drain_time, checkpoint_times) = quiesce(step_end)
+        data['drain_time'] = drain_time
+        data['drain_notpm'] = (float(notpm)*(float(duration)/60))/(float(duration) + float(drain_time)) * 60
+        data['checkpoint_time'] = max(t for (_, t) in checkpoint_times)
+        for (node_name, t) in checkpoint_times:
+            data['%s_checkpoint_time' % node_name] = t
+
+    # Lag time series statistics
+    if sampler.error is not None:
+        print("WARNING: lag sampling failed: %s" % sampler.error,
+              file=sys.stderr)
+    series_stats = lag_series_stats(
+        sampler.samples, float(notpm), env.lag_slope_window
+    )
+    # All the nodes get all the columns, even when the lag sampling failed
+    nodes = set(series_stats) | set(
+        k[:-len('_catchup_time')] for k in data if k.endswith('_catchup_time')
+    )
+    for node_name in sorted(nodes):
+        stats = series_stats.get(node_name, {})
+        for k in LAG_SERIES_STATS:
+            data['%s_%s' % (node_name, k)] = stats.get(k, '')
+    suffix = '_series_notpm' if env.objective == 'series' \
+        else '_sustainable_notpm'
+    rates = [
+        v for (k, v) in data.items() if k.endswith(suffix) and v != ''
+    ]
+    data['sustainable_notpm'] = min(rates) if rates else float(notpm)
+    if env.lag_series_dir:
+        sampler.save(os.path.join(
+            env.lag_series_dir,
+            'lag-%s-t%d.csv' % (timestamp.replace(':', ''), terminal)
+        ))
+
+    # Throughput stability, from the per second throughput
+    series = [n for (_, n) in mix_log.throughput()]
+    data['notpm_min'] = "%.2f" % min(series) if series else ''
+    data['notpm_stddev'] = \
+        "%.2f" % statistics.pstdev(series) if series else ''
+
+    # Response time percentiles of each transaction type
+    data.update(mix_log.latencies())
+
+    return data
+
+
+def sustainable_notpm(data):
+    """
+    Returns the sustainable NOTPM of the cluster, as computed by the step, or
+    the NOTPM if there is no replication data
+    """
+    if data.get('sustainable_notpm') not in (None, ''):
+        return float(data['sustainable_notpm'])
+    # Steps recorded by previous versions: lowest sustainable NOTPM of all
+    # the nodes
+    rates = [
+        float(v) for (k, v) in data.items()
+        if k.endswith('_sustainable_notpm') and v not in (None, '')
+    ]
+    if rates:
+        return min(rates)
+    return float(data['notpm'])
+
+
+def search_max_throughput(env, measure):
+    """
+    Search for the number of terminals giving the highest sustainable NOTPM,
+    assuming a single maximum. The number of terminals is doubled until the
+    gain falls below the tolerance, then the bracket around the best
+    number of terminals is narrowed until its sub-intervals are not larger
+    than the step, or the gain between 2 probes falls below the tolerance.
+    measure(terminals) executes a step and returns its sustainable NOTPM.
+    Returns the best number of terminals and its sustainable NOTPM.
+    """
+    results = {}
+
+    def probe(t):
+        if t not in results:
+            results[t] = measure(t)
+        return results[t]
+
+    def gain(a, b):
+        # Relative gain of b over a
+        return (b - a) / a if a > 0 else float('inf')
+
+    # Exponential probing
+    lo = env.start_terminal
+    best = env.start_terminal
+    probe(best)
+    while best < env.max_terminal:
+        t = min(best * 2, env.max_terminal)
+        if gain(results[best], probe(t)) < env.tolerance:
+            hi = t
+            break
+        lo = best
+        best = t
+    else:
+        return (best, results[best])
+
+    # Narrow the bracket [lo, hi] around the best number of terminals
+    while True:
+        if best - lo >= hi - best:
+            t = (lo + best) // 2
+        else:
+            t = (best + hi) // 2
+        if t in results or max(best - lo, hi - best) <= env.step:
+            break
+        g = gain(results[best], probe(t))
+        if g > 0:
+            # New best: the bracket is shrunk around it
+            if t < best:
+                hi = best
+            else:
+                lo = best
+            best = t
+        elif t < best:
+            lo = t
+        else:
+            hi = t
+        if abs(g) < env.tolerance:
+            break
+
+    return (best, results[best])
+
+
+def read_journal(path):
+    """
+    Returns the results of the steps recorded in the journal, by number of
+    terminals
+    """
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                data = json.loads(
+                    line, object_pairs_hook=collections.OrderedDict
+                )
+            except ValueError:
+                # Partially written record
+                continue
+            # Open loop steps are identified by their target
+            results[data.get('target_notpm', data['terminals'])] = data
+    return results
+
+
+def write_journal(path, data):
+    """
+    Append the results of a step to the journal, durably
+    """
+    with open(path, 'a') as f:
+        f.write("%s\n" % json.dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def stop_dbt2_client(client):
+    """
+    Kill any dbt2-client process left on the client machine
+    """
+    subprocess.run(
+        'ssh %s \'pkill dbt2-client\'' % client,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--client', '-c',
@@ -106,6 +1319,174 @@ if __name__ == '__main__':
         help="Test duration in seconds. Default: %(default)s",
         default=100,
     )
+    parser.add_argument(
+        '--lag-interval',
+        dest='lag_interval',
+        type=float,
+        help="Replication lag sampling interval, in seconds, during each "
+             "step. Default: %(default)s",
+        default=1,
+    )
+    parser.add_argument(
+        '--lag-slope-window',
+        dest='lag_slope_window',
+        type=float,
+        help="Duration, in seconds, of the end of step period used to "
+             "compute the lag slope. Default: %(default)s",
+        default=30,
+    )
+    parser.add_argument(
+        '--objective',
+        dest='objective',
+        choices=('catchup', 'series'),
+        help="Sustainable NOTPM used as objective: computed from the catchup "
+             "time after each step, or from the lag time series of the "
+             "step. Default: %(default)s",
+        default='catchup',
+    )
+    parser.add_argument(
+        '--lag-series-dir',
+        dest='lag_series_dir',
+        type=str,
+        help="Save the replication lag time series of each step in this "
+             "directory.",
+    )
+    parser.add_argument(
+        '--telemetry-host',
+        dest='telemetry_hosts',
+        action='append',
+        default=[],
+        help="Collect the resource usage of this host, through SSH, during "
+             "each step. 'local' stands for the local host. Can be used "
+             "multiple times.",
+    )
+    parser.add_argument(
+        '--telemetry-interval',
+        dest='telemetry_interval',
+        type=float,
+        help="Host resource usage sampling interval in seconds. Default: "
+             "%(default)s",
+        default=1,
+    )
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        action='store_true',
+        default=False,
+        help="Profile all the BDR nodes during each step: wait events, "
+             "statements, checkpoint and WAL write pressure.",
+    )
+    parser.add_argument(
+        '--profile-interval',
+        dest='profile_interval',
+        type=float,
+        help="Profiler: wait events sampling interval in seconds. Default: "
+             "%(default)s",
+        default=0.05,
+    )
+    parser.add_argument(
+        '--profile-dir',
+        dest='profile_dir',
+        type=str,
+        help="Profiler: save the detailed profile of each step in this "
+             "directory.",
+    )
+    parser.add_argument(
+        '--quiesce',
+        dest='quiesce',
+        action='store_true',
+        default=False,
+        help="After each step, wait for the replication lag of all the BDR "
+             "nodes to be drained, then checkpoint all the nodes "
+             "concurrently.",
+    )
+    parser.add_argument(
+        '--drain-poll',
+        dest='drain_poll',
+        type=float,
+        help="Quiesce: replication lag polling interval in seconds. Default: "
+             "%(default)s",
+        default=0.1,
+    )
+    parser.add_argument(
+        '--drain-timeout',
+        dest='drain_timeout',
+        type=float,
+        help="Quiesce: maximum time, in seconds, to wait for the replication "
+             "lag to be drained. Default: %(default)s",
+        default=3600,
+    )
+    parser.add_argument(
+        '--journal', '-J',
+        dest='journal',
+        type=str,
+        help="Record the results of each completed step in this file.",
+    )
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        action='store_true',
+        default=False,
+        help="Resume an interrupted run: steps recorded in the journal are "
+             "not executed again.",
+    )
+    parser.add_argument(
+        '--driver-host',
+        dest='driver_hosts',
+        type=str,
+        action='append',
+        help="Execute dbt2-driver on this host, through SSH, 'local' for the "
+             "local host. Can be used multiple times: warehouses and "
+             "terminals are split between the driver hosts.",
+    )
+    parser.add_argument(
+        '--steady-state',
+        dest='steady_state',
+        action='store_true',
+        default=False,
+        help="End each step once the throughput is stable, between the "
+             "minimum and maximum durations. --duration is ignored.",
+    )
+    parser.add_argument(
+        '--min-duration',
+        dest='min_duration',
+        type=int,
+        help="Steady state: minimum step duration in seconds. Default: "
+             "%(default)s",
+        default=60,
+    )
+    parser.add_argument(
+        '--max-duration',
+        dest='max_duration',
+        type=int,
+        help="Steady state: maximum step duration in seconds. Default: "
+             "%(default)s",
+        default=600,
+    )
+    parser.add_argument(
+        '--steady-window',
+        dest='steady_window',
+        type=int,
+        help="Steady state: sliding window, in seconds, over which the "
+             "throughput variation is computed. Default: %(default)s",
+        default=30,
+    )
+    parser.add_argument(
+        '--steady-interval',
+        dest='steady_interval',
+        type=int,
+        help="Steady state: throughput is measured per interval of N "
+             "seconds. Default: %(default)s",
+        default=5,
+    )
+    parser.add_argument(
+        '--steady-cv',
+        dest='steady_cv',
+        type=float,
+        help="Steady state: the throughput is stable when its coefficient of "
+             "variation is lower than this value. Default: %(default)s",
+        default=0.1,
+    )
     parser.add_argument(
         '--warehouse', '-w',
         dest='warehouse',
@@ -134,6 +1515,73 @@ if __name__ == '__main__':
         help="Increase the number of terminal by this value. Default: %(default)s",
         default=1,
     )
+    parser.add_argument(
+        '--search',
+        dest='search',
+        action='store_true',
+        default=False,
+        help="Search for the number of terminals, between the starting and "
+             "maximum numbers, giving the highest sustainable NOTPM, instead "
+             "of increasing it step by step.",
+    )
+    parser.add_argument(
+        '--tolerance',
+        dest='tolerance',
+        type=float,
+        help="Search mode: stop when the relative sustainable NOTPM gain "
+             "between 2 probes is lower than this value. Default: "
+             "%(default)s",
+        default=0.02,
+    )
+    parser.add_argument(
+        '--load-profile',
+        dest='load_profile',
+        type=parse_load_profile,
+        help="Apply this load profile during -d seconds, instead of steps: "
+             "constant:notpm=N, spike:base=N,peak=N,start=S,length=S, "
+             "square:low=N,high=N,period=S, "
+             "sine:mean=N,amplitude=N,period=S,phase=S or "
+             "replay:file=PATH,scale=X,speed=X.",
+    )
+    parser.add_argument(
+        '--unit-notpm',
+        dest='unit_notpm',
+        type=float,
+        help="Load profile: NOTPM offered by each dbt2-driver process. "
+             "Default: %(default)s",
+        default=5000,
+    )
+    parser.add_argument(
+        '--timeline',
+        dest='timeline',
+        type=str,
+        help="Load profile: timeline CSV output file. Default: standard "
+             "output",
+    )
+    parser.add_argument(
+        '--target-notpm',
+        dest='target_notpm',
+        type=parse_schedule,
+        help="Open loop mode: comma separated list of target NOTPM, one per "
+             "step, or percentages of --max-notpm (ex: 50%%,80%%,100%%). "
+             "The number of terminals and their thinking time are computed "
+             "to offer this load.",
+    )
+    parser.add_argument(
+        '--max-notpm',
+        dest='max_notpm',
+        type=float,
+        help="Open loop mode: maximum NOTPM, reference of the relative "
+             "targets.",
+    )
+    parser.add_argument(
+        '--terminal-rate',
+        dest='terminal_rate',
+        type=float,
+        help="Open loop mode: number of transactions per second executed by "
+             "each terminal. Default: %(default)s",
+        default=2,
+    )
     parser.add_argument(
         '--pg',
         dest='pg',
@@ -170,52 +1618,141 @@ if __name__ == '__main__':
     )
     env = parser.parse_args()
 
+    if env.resume and not env.journal:
+        parser.error("--resume requires --journal")
+
+    if env.load_profile:
+        # Load profile: the dbt2-client is started, the profile applied, and
+        # the timeline written
+        client = start_dbt2_client(
+            env.client, env.proxy, env.dbname, env.port, env.connections
+        )
+        time.sleep(60)
+        try:
+            if env.timeline:
+                with open(env.timeline, 'w') as out:
+                    run_load_profile(env, *env.load_profile, out)
+            else:
+                run_load_profile(env, *env.load_profile, sys.stdout)
+        finally:
+            client.kill()
+        return
+    if env.target_notpm and any(r for (_, r) in env.target_notpm) \
+            and not env.max_notpm:
+        parser.error("relative --target-notpm values require --max-notpm")
+
     try:
         conn = psycopg2.connect(env.pg)
         conn.set_session(autocommit=True)
     except psycopg2.Error as e:
         sys.exit("Unable to connect to the database")
 
-    # Starting dbt2-client
-    client = start_dbt2_client(
-        env.client, env.proxy, env.dbname, env.port, env.connections
-    )
-    # Waiting a moment before starting the driver process: we want to let a
-    # decent amount of time to the client to start all the required
-    # database connections.
-    time.sleep(60)
-
+    quiesce = None
+    if env.quiesce:
+        try:
+            quiesce = Quiesce(conn, env.drain_poll, env.drain_timeout)
+            # First step must start on a quiet cluster too
+            quiesce(time.monotonic())
+        except psycopg2.Error as e:
+            sys.exit("Unable to quiesce the BDR nodes: %s" % e)
 
-    i = 0
-    for t in range(env.start_terminal, env.max_terminal, env.step):
-        # Execute a checkpoint
-        checkpoint(conn)
-        # Execute dbt2-driver
-        notpm = exec_driver(env.client, env.duration, env.warehouse, t)
-        timestamp = datetime.datetime.utcnow().isoformat()
+    profiler = None
+    if env.profile:
+        try:
+            profiler = pg_profiler.Profiler(
+                bdr_nodes(conn), env.profile_interval, env.profile_dir
+            )
+        except psycopg2.Error as e:
+            sys.exit("Unable to connect to the BDR nodes: %s" % e)
 
-        data = {}
-        data['timestamp'] = timestamp
-        data['terminals'] = t
-        data['notpm'] = notpm
+    # Host resource telemetry agents, running during the whole rampup
+    agents = [
+        host_stats.Agent(host, env.telemetry_interval)
+        for host in env.telemetry_hosts
+    ]
 
-        # Get catchup time
-        for (c_slot_name, c_time) in catchup_time(conn):
-            node_name = c_slot_name.replace('bdr_edb_bdrdb_group_', '')
+    journal = {}
+    if env.resume:
+        journal = read_journal(env.journal)
+        # The client may have been left behind by the interrupted run
+        stop_dbt2_client(env.client)
 
-            if node_name.startswith('witness'):
-                # Just ignore what's going on with the witness node
-                continue
+    def start_client():
+        # Starting dbt2-client
+        client = start_dbt2_client(
+            env.client, env.proxy, env.dbname, env.port, env.connections
+        )
+        # Waiting a moment before starting the driver process: we want to let
+        # a decent amount of time to the client to start all the required
+        # database connections.
+        time.sleep(60)
+        return client
 
-            data['%s_catchup_time' % node_name] = c_time
-            # Calculate sustainable rate
-            sustainable_rate = (float(notpm)*(float(env.duration)/60))/(float(env.duration) + float(c_time)) * 60
-            data['%s_sustainable_notpm' % node_name] = sustainable_rate
+    client = None
+    steps = []
+    header = None
 
-        # Display headers on the first iteration
-        if i == 0:
-            print(','.join(list(data.keys())))
+    def execute(key, t, target_notpm=None, think_time=0):
+        nonlocal client, header
+        if key in journal:
+            # Step already completed by a previous run
+            data = journal[key]
+        else:
+            if client is None or client.poll() is not None:
+                # dbt2-client not started yet, or dead
+                if client is not None:
+                    stop_dbt2_client(env.client)
+                client = start_client()
+            data = run_step(
+                env, conn, t, quiesce, agents, profiler, target_notpm,
+                think_time
+            )
+            if env.journal:
+                write_journal(env.journal, data)
+        # Display headers on the first iteration, and again if the columns
+        # change, when a node joined or parted the cluster
+        if list(data.keys()) != header:
+            header = list(data.keys())
+            print(','.join(header))
         print(','.join([str(v) for _, v in data.items()]))
-        i += 1
+        sys.stdout.flush()
+        steps.append(data)
+        return data
+
+    def measure(t):
+        return sustainable_notpm(execute(t, t))
+
+    try:
+        if env.target_notpm:
+            # Open loop: the response time of the previous step is taken into
+            # account to compute the thinking time
+            response_time = 0.0
+            for (value, relative) in env.target_notpm:
+                target = value * env.max_notpm / 100 if relative else value
+                (t, think_time) = open_loop(
+                    target, env.terminal_rate, response_time
+                )
+                data = execute("%.2f" % target, t, target, think_time)
+                response_time = float(data['mean_response_time'])
+        elif env.search:
+            (best, rate) = search_max_throughput(env, measure)
+            print(
+                "Highest sustainable NOTPM: %s with %s terminals, %s steps"
+                % (rate, best, len(steps)),
+                file=sys.stderr
+            )
+        else:
+            for t in range(env.start_terminal, env.max_terminal, env.step):
+                measure(t)
+    finally:
+        for agent in agents:
+            agent.stop()
+        if profiler is not None:
+            profiler.close()
 
-    client.kill()
+    if client is not None:
+        client.kill()
+
+
+if __name__ == '__main__':
+    main()
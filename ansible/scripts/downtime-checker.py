@@ -1,77 +1,473 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
+import json
+from array import array
 import psycopg2
+import psycopg2.extensions
+from psycopg2.extensions import make_dsn, parse_dsn
+import statistics
+import sys
 import time
 from datetime import datetime as dt
 from subprocess import Popen, PIPE
 
-def connect(conn_string):
-    while True:
-        try:
-            print("%s INFO: Connecting to PostgreSQL..." % dt.now())
-            conn = psycopg2.connect(conn_string)
-            print("%s INFO: Connected." % dt.now())
-            return conn
-        except psycopg2.Error as e:
-            print("%s ERROR: Cannot connect, new try." % dt.now())
 
+# BDR node of a connection, fetched once per connection, and read probe
+NODE_QUERY = "SELECT node_name FROM bdr.local_node_info()"
+PROBE_QUERY = "INSERT INTO ping (bdr_node) VALUES (%s)"
+# Server side verification of an unavailability window, backed by the
+# ping (bdr_node, timestamp) index
+VERIFY_QUERY = """
+SELECT EXTRACT(epoch FROM (
+  SELECT MIN(timestamp) FROM ping
+  WHERE bdr_node = %(after)s AND timestamp >= to_timestamp(%(start)s)
+) - (
+  SELECT MAX(timestamp) FROM ping
+  WHERE bdr_node = %(before)s AND timestamp <= to_timestamp(%(end)s)
+))
+"""
+# Margin, in seconds, around the windows for the server side verification
+VERIFY_MARGIN = 1.0
 
-def monitor_downtime(conn, pg):
-    bdr_leader_init = None
-    bdr_leader_current = None
-    downtime = None
 
+# Outage phases, in seconds:
+# - detection: from the send of the failed write to the error, or timeout
+# - reconnect: from the detection to the new connection, backoff included
+# - tcp_connect and authentication: successful connection attempt
+# - first_write: from the new connection to the first successful write
+# - new_leader: from the detection to the first write on another BDR node
+PHASES = (
+    'detection', 'reconnect', 'tcp_connect', 'authentication', 'first_write',
+    'new_leader',
+)
+
+
+async def wait(conn, trace=None):
+    """
+    Wait for the completion of the current operation of an asynchronous
+    connection. The time of each state change is appended to trace.
+    """
+    loop = asyncio.get_event_loop()
     while True:
+        state = conn.poll()
+        if trace is not None:
+            trace.append((time.monotonic(), state))
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        fd = conn.fileno()
+        ready = loop.create_future()
+
+        def done():
+            if not ready.done():
+                ready.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, done)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, done)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fd)
+
+
+class Timeline(object):
+    """
+    Fixed-size ring buffer of the probe writes: send and acknowledgement
+    times, and index of the BDR node name, -1 for a failed write. Only the
+    last size writes are kept.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.send = array('d', [0.0]) * size
+        self.ack = array('d', [0.0]) * size
+        self.node = array('h', [0]) * size
+        self.nodes = []
+        self.count = 0
+
+    def append(self, send, ack, node):
+        if node is None:
+            index = -1
+        else:
+            if node not in self.nodes:
+                self.nodes.append(node)
+            index = self.nodes.index(node)
+        i = self.count % self.size
+        self.send[i] = send
+        self.ack[i] = ack
+        self.node[i] = index
+        self.count += 1
+
+    def __iter__(self):
+        """
+        Yields (send time, ack time, BDR node name or None), oldest first
+        """
+        for n in range(max(0, self.count - self.size), self.count):
+            i = n % self.size
+            index = self.node[i]
+            yield (
+                self.send[i], self.ack[i],
+                self.nodes[index] if index >= 0 else None
+            )
+
+
+class Probe(object):
+    """
+    Probe connection: executes a write at a fixed rate and records, for each
+    write, its send and acknowledgement times, taken from the monotonic clock,
+    and the BDR node it landed on, in a ring buffer. A failed write is
+    recorded without node. Unavailability windows are computed as the writes
+    are acknowledged: from the acknowledgement of the last successful write
+    before a failure, to the acknowledgement of the first successful write
+    after it.
+
+    A read probe connection executes a read instead, returning the BDR node
+    that served it, and is otherwise handled like a write.
+
+    A write not acknowledged within write_timeout seconds is a failure. The
+    connection is then reopened with an exponential backoff, each attempt
+    being bounded by connect_timeout seconds, and the phases of the outage are
+    recorded.
+    """
+
+    def __init__(self, probe_id, pg, interval, offset, connect_timeout=2,
+                 write_timeout=2, backoff_min=0.05, backoff_max=2,
+                 timeline_size=100000, endpoint=None, mode='write'):
+        self.probe_id = probe_id
+        self.pg = pg
+        # Proxy endpoint name, and probe mode: 'write' or 'read'
+        self.endpoint = endpoint
+        self.mode = mode
+        self.name = "probe %d (%s %s)" % (probe_id, endpoint, mode)
+        self.interval = interval
+        self.offset = offset
+        self.connect_timeout = connect_timeout
+        self.write_timeout = write_timeout
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.conn = None
+        # BDR node of the current connection
+        self.node = None
+        self.timeline = Timeline(timeline_size)
+        # Last successful write (ack time, BDR node), and failure flag
+        self.last_ok = None
+        self.failed = False
+        # List of (start, end, node before, node after)
+        self.windows = []
+        self.last_node = None
+        # Current outage and phases of the past outages
+        self.outage = None
+        self.outages = []
+        self.stopping = False
+
+    async def open(self):
+        """
+        One connection attempt. Returns the TCP connect and authentication
+        durations. libpq waits for the socket to be writable until the TCP
+        connection is established, then the startup and authentication
+        messages are exchanged.
+        """
+        start = time.monotonic()
+        trace = []
+        conn = psycopg2.connect(self.pg, async_=1)
+        try:
+            await asyncio.wait_for(wait(conn, trace), self.connect_timeout)
+        except (psycopg2.Error, asyncio.TimeoutError):
+            conn.close()
+            raise
+        reading = [
+            t for (t, state) in trace
+            if state != psycopg2.extensions.POLL_WRITE
+        ]
+        connected = trace[-1][0]
+        tcp_connect = reading[0] - start
+        # Through a proxy, the connection stays on the same BDR node
         try:
             cur = conn.cursor()
-            # Not leader found yet? then this is the first iteration and we
-            # must remove any data from the ping table.
-            if bdr_leader_init is None:
-                cur.execute("TRUNCATE ping")
-
-            # Get BDR leader name
-            if bdr_leader_init is None or bdr_leader_current is None:
-                cur.execute("SELECT node_name FROM bdr.local_node_info()")
-                r = cur.fetchone()
-                if bdr_leader_init is None:
-                    bdr_leader_init = r[0]
-                if bdr_leader_current is None:
-                    bdr_leader_current = r[0]
-
-            # Insert a new record into the ping table
-            cur.execute(
-                "INSERT INTO ping (bdr_node) VALUES "
-                "((SELECT node_name FROM bdr.local_node_info()))"
-            )
-            conn.commit()
-
-            # If the current BDR leader node is different from the initial one,
-            # then this must indicate a new BDR leader node has been promoted.
-            if bdr_leader_current != bdr_leader_init:
-                cur2 = conn.cursor()
-                cur2.execute(
-                    "SELECT MIN(timestamp) - ("
-                    "  SELECT MAX(timestamp) FROM ping where bdr_node = %s"
-                    ") FROM ping WHERE bdr_node = %s",
-                    (bdr_leader_init, bdr_leader_current)
-                )
-                r2 = cur2.fetchone()
-                downtime = r2[0]
-                conn.commit()
-                return downtime
-
-        except psycopg2.OperationalError as e:
-            # Connection to the database has been lost, this must be due to a
-            # leader change, then we reset bdr_leader_current to None.
-            bdr_leader_current = None
-            print("%s ERROR: Connection lost" % dt.now())
-            conn = connect(pg)
-        except psycopg2.DatabaseError as e:
-            bdr_leader_current = None
-            print(e)
-            print("%s ERROR: Cannot insert message" % dt.now())
-            conn = connect(pg)
+            cur.execute(NODE_QUERY)
+            await asyncio.wait_for(wait(conn), self.write_timeout)
+            self.node = cur.fetchone()[0]
+            cur.close()
+        except (psycopg2.Error, asyncio.TimeoutError):
+            conn.close()
+            raise
+        self.conn = conn
+        return (tcp_connect, connected - start - tcp_connect)
+
+    async def connect(self):
+        backoff = self.backoff_min
+        while self.conn is None and not self.stopping:
+            if self.outage is not None:
+                self.outage['attempts'] += 1
+            try:
+                (tcp_connect, authentication) = await self.open()
+            except (psycopg2.Error, asyncio.TimeoutError):
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+            if self.outage is not None:
+                o = self.outage
+                o['connected'] = time.monotonic()
+                o['reconnect'] = o['connected'] - o['detected']
+                o['tcp_connect'] = tcp_connect
+                o['authentication'] = authentication
+                print("%s INFO: %s connected after %d attempts"
+                      % (dt.now(), self.name, o['attempts']))
+
+    def lost(self, send):
+        detected = time.monotonic()
+        self.timeline.append(send, detected, None)
+        self.failed = True
+        self.conn.close()
+        self.conn = None
+        if self.outage is not None:
+            # Already in an outage, not recovered yet
+            return
+        print("%s ERROR: %s connection lost" % (dt.now(), self.name))
+        self.outage = {
+            'node_before': self.last_node,
+            'send': send,
+            'detected': detected,
+            'detection': detected - send,
+            'attempts': 0,
+        }
+
+    def acknowledged(self, send, node):
+        ack = time.monotonic()
+        self.timeline.append(send, ack, node)
+        if self.failed and self.last_ok is not None:
+            self.windows.append((self.last_ok[0], ack, self.last_ok[1], node))
+        self.failed = False
+        self.last_ok = (ack, node)
+        self.last_node = node
+        o = self.outage
+        if o is None:
+            return
+        o['first_write'] = ack - o['connected']
+        if node != o['node_before']:
+            o['new_leader'] = ack - o['detected']
+        # Reconnected to the same node: the outage ends without new leader,
+        # a later failure is recorded as another outage
+        self.end_outage()
+
+    def end_outage(self):
+        o = self.outage
+        self.outage = None
+        self.outages.append(dict(
+            (k, o.get(k)) for k in PHASES + ('node_before', 'attempts')
+        ))
+
+    async def probe(self):
+        send = time.monotonic()
+        try:
+            cur = self.conn.cursor()
+            if self.mode == 'read':
+                cur.execute(NODE_QUERY)
+            else:
+                cur.execute(PROBE_QUERY, (self.node,))
+            await asyncio.wait_for(wait(self.conn), self.write_timeout)
+            node = cur.fetchone()[0] if self.mode == 'read' else self.node
+            cur.close()
+        except (psycopg2.Error, asyncio.TimeoutError):
+            self.lost(send)
+            return
+        self.acknowledged(send, node)
+
+    async def run(self):
+        # Probes are spread over the interval
+        next_probe = time.monotonic() + self.offset
+        while not self.stopping:
+            await asyncio.sleep(max(0, next_probe - time.monotonic()))
+            if self.conn is None:
+                await self.connect()
+                if self.conn is None:
+                    break
+            await self.probe()
+            next_probe += self.interval
+            if next_probe < time.monotonic():
+                # Late: do not try to catch up
+                next_probe = time.monotonic()
+        if self.conn is not None:
+            self.conn.close()
+        if self.outage is not None:
+            # The probe has not reached a new BDR node
+            self.end_outage()
+
+    def failovers(self):
+        """
+        Number of outages ended by a write on another BDR node
+        """
+        return len([o for o in self.outages if o['new_leader'] is not None])
+
+
+async def monitor_downtime(probes, duration, failovers=1):
+    """
+    Run the probes until all of them have gone through failovers changes of
+    BDR leader node, or during duration seconds if set
+    """
+    tasks = [asyncio.ensure_future(p.run()) for p in probes]
+    start = time.monotonic()
+    while True:
+        await asyncio.sleep(0.1)
+        if duration:
+            if time.monotonic() - start >= duration:
+                break
+        elif all(p.failovers() >= failovers for p in probes):
+            break
+    for p in probes:
+        p.stopping = True
+    await asyncio.gather(*tasks)
+
+
+def phases_summary(probes):
+    """
+    Returns the min, median and max duration of each outage phase, over all
+    the probes
+    """
+    summary = {}
+    for phase in PHASES:
+        values = [
+            o[phase] for p in probes for o in p.outages
+            if o.get(phase) is not None
+        ]
+        if values:
+            summary[phase] = {
+                'min': min(values),
+                'median': statistics.median(values),
+                'max': max(values),
+            }
+    return summary
+
+
+def windows_summary(probes, origin):
+    """
+    Returns the list of the unavailability windows of all the probes, and
+    their min, median and max duration in seconds. origin is the
+    (monotonic time, epoch) of the beginning of the probing.
+    """
+    windows = []
+    for p in probes:
+        windows += [
+            {
+                'probe': p.probe_id,
+                'endpoint': p.endpoint,
+                'mode': p.mode,
+                'start': origin[1] + start - origin[0],
+                'end': origin[1] + end - origin[0],
+                'duration': end - start,
+                'node_before': before,
+                'node_after': after,
+            }
+            for (start, end, before, after) in p.windows
+        ]
+    durations = [w['duration'] for w in windows]
+    if not durations:
+        return (windows, None)
+    return (windows, {
+        'min': min(durations),
+        'median': statistics.median(durations),
+        'max': max(durations),
+    })
+
+
+def endpoints_summary(windows):
+    """
+    Returns, per endpoint and probe mode, the min, median and max duration of
+    the unavailability windows, and the recovery time: from the start of the
+    first window of the run, all endpoints included, to the end of the last
+    window of the endpoint
+    """
+    if not windows:
+        return []
+    first = min(w['start'] for w in windows)
+    groups = {}
+    for w in windows:
+        groups.setdefault((w['endpoint'], w['mode']), []).append(w)
+    summary = []
+    for ((endpoint, mode), w) in sorted(groups.items()):
+        durations = [x['duration'] for x in w]
+        summary.append({
+            'endpoint': endpoint,
+            'mode': mode,
+            'windows': len(w),
+            'min': min(durations),
+            'median': statistics.median(durations),
+            'max': max(durations),
+            'recovered': max(x['end'] for x in w) - first,
+        })
+    return summary
+
+
+def verify_windows(endpoints, windows):
+    """
+    Server side verification: the duration of each write window between two
+    different BDR nodes is computed again from the ping table, through the
+    endpoint of the window
+    """
+    for (endpoint, pg) in endpoints:
+        verify_endpoint_windows(pg, [
+            w for w in windows
+            if w['endpoint'] == endpoint and w['mode'] == 'write'
+            and w['node_before'] != w['node_after']
+        ])
+
+
+def verify_endpoint_windows(pg, windows):
+    if not windows:
+        return
+    conn = psycopg2.connect(pg)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    for w in windows:
+        cur.execute(VERIFY_QUERY, {
+            'before': w['node_before'],
+            'after': w['node_after'],
+            'start': w['start'] - VERIFY_MARGIN,
+            'end': w['end'] + VERIFY_MARGIN,
+        })
+        r = cur.fetchone()[0]
+        w['server_duration'] = float(r) if r is not None else None
+    cur.close()
+    conn.close()
+
+
+def write_timeline(path, probes, origin):
+    """
+    Export the probe writes kept in the ring buffers, in CSV format
+    """
+    with open(path, 'w') as f:
+        f.write("probe,endpoint,mode,send,ack,bdr_node\n")
+        for p in probes:
+            for (send, ack, node) in p.timeline:
+                f.write("%d,%s,%s,%.6f,%.6f,%s\n" % (
+                    p.probe_id, p.endpoint, p.mode,
+                    origin[1] + send - origin[0],
+                    origin[1] + ack - origin[0], node or ''
+                ))
+
+
+def read_endpoints(path, pg):
+    """
+    Returns the list of (name, connection string) of the proxy endpoints
+    listed in a file, one '<name> <host>' per line. The other connection
+    parameters are taken from the pg connection string.
+    """
+    endpoints = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            (name, host) = line.split()
+            endpoints.append((name, make_dsn(pg, host=host)))
+    return endpoints
 
 
 def start_dbt2_client(client, proxy, dbname, port, connections):
@@ -131,9 +527,18 @@ def main():
         '--pg',
         dest='pg',
         type=str,
-        help="Postgres connection string to the Harp proxy node.",
+        help="Postgres connection string to the Harp proxy node. With "
+             "--endpoints, connection parameters common to all the proxy "
+             "endpoints.",
         default='',
     )
+    parser.add_argument(
+        '--endpoints',
+        dest='endpoints',
+        type=str,
+        help="File listing the proxy endpoints to probe at the same time, one "
+             "'<name> <host>' per line.",
+    )
     parser.add_argument(
         '--traffic', '-T',
         dest='traffic',
@@ -189,6 +594,105 @@ def main():
         help="Additional traffic: number of TPC-C terminals. Default: %(default)s",
         default=12,
     )
+    parser.add_argument(
+        '--probes', '-n',
+        dest='probes',
+        type=int,
+        help="Number of concurrent write probe connections, per endpoint. "
+             "Default: %(default)s",
+        default=1,
+    )
+    parser.add_argument(
+        '--read-probes',
+        dest='read_probes',
+        type=int,
+        help="Number of concurrent read probe connections, per endpoint. "
+             "Default: %(default)s",
+        default=0,
+    )
+    parser.add_argument(
+        '--rate', '-r',
+        dest='rate',
+        type=float,
+        help="Number of writes or reads per second, per probe connection. "
+             "Default: %(default)s",
+        default=10,
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        dest='connect_timeout',
+        type=float,
+        help="Maximum duration, in seconds, of a connection attempt. "
+             "Default: %(default)s",
+        default=2,
+    )
+    parser.add_argument(
+        '--write-timeout',
+        dest='write_timeout',
+        type=float,
+        help="Maximum duration, in seconds, of a write before the connection "
+             "is considered lost. Default: %(default)s",
+        default=2,
+    )
+    parser.add_argument(
+        '--backoff-min',
+        dest='backoff_min',
+        type=float,
+        help="Delay, in seconds, before a new connection attempt. Doubled "
+             "after each failed attempt. Default: %(default)s",
+        default=0.05,
+    )
+    parser.add_argument(
+        '--backoff-max',
+        dest='backoff_max',
+        type=float,
+        help="Maximum delay, in seconds, before a new connection attempt. "
+             "Default: %(default)s",
+        default=2,
+    )
+    parser.add_argument(
+        '--duration',
+        dest='duration',
+        type=float,
+        help="Probing duration in seconds. Default: until all the probe "
+             "connections have gone through --failovers changes of BDR "
+             "leader node",
+    )
+    parser.add_argument(
+        '--failovers',
+        dest='failovers',
+        type=int,
+        help="Number of changes of BDR leader node to wait for. Default: "
+             "%(default)s",
+        default=1,
+    )
+    parser.add_argument(
+        '--timeline-size',
+        dest='timeline_size',
+        type=int,
+        help="Number of writes kept in memory, per probe connection. "
+             "Default: %(default)s",
+        default=100000,
+    )
+    parser.add_argument(
+        '--timeline',
+        dest='timeline',
+        type=str,
+        help="Export the writes kept in memory, in CSV format, in this file.",
+    )
+    parser.add_argument(
+        '--verify',
+        dest='verify',
+        action='store_true',
+        default=False,
+        help="Verify the unavailability windows against the ping table.",
+    )
+    parser.add_argument(
+        '--output', '-o',
+        dest='output',
+        type=str,
+        help="Write the result, in JSON format, in this file.",
+    )
     env = parser.parse_args()
     driver = None
     client = None
@@ -207,10 +711,99 @@ def main():
             env.client, env.warehouse, env.terminal
         )
 
-    conn = connect(env.pg)
-    downtime = monitor_downtime(conn, env.pg)
-    print("Downtime: %s" % downtime)
-    conn.close()
+    if env.endpoints:
+        try:
+            endpoints = read_endpoints(env.endpoints, env.pg)
+        except (IOError, ValueError, psycopg2.Error) as e:
+            sys.exit("Unable to read the endpoints file: %s" % e)
+    else:
+        endpoints = [(parse_dsn(env.pg).get('host', 'local'), env.pg)]
+
+    # Write and read probe connections of each endpoint, their queries are
+    # evenly spread over time
+    modes = ['write'] * env.probes + ['read'] * env.read_probes
+    count = len(endpoints) * len(modes)
+    interval = 1.0 / env.rate
+    probes = []
+    for (endpoint, pg) in endpoints:
+        for mode in modes:
+            i = len(probes)
+            probes.append(Probe(
+                i, pg, interval, interval * i / count,
+                env.connect_timeout, env.write_timeout, env.backoff_min,
+                env.backoff_max, env.timeline_size, endpoint, mode
+            ))
+    origin = (time.monotonic(), time.time())
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(
+            monitor_downtime(probes, env.duration, env.failovers)
+        )
+    except KeyboardInterrupt:
+        for p in probes:
+            p.stopping = True
+    (windows, downtime) = windows_summary(probes, origin)
+    if env.verify:
+        try:
+            verify_windows(endpoints, windows)
+        except psycopg2.Error as e:
+            print("%s ERROR: Cannot verify the windows: %s" % (dt.now(), e))
+    if env.timeline:
+        write_timeline(env.timeline, probes, origin)
+    if downtime is None:
+        print("Downtime: none")
+    else:
+        print("Downtime: min=%.3fs median=%.3fs max=%.3fs (%d windows, "
+              "%d probes)" % (
+                  downtime['min'], downtime['median'], downtime['max'],
+                  len(windows), len(probes)
+              ))
+    per_endpoint = endpoints_summary(windows)
+    if len(endpoints) > 1 or env.read_probes:
+        for e in per_endpoint:
+            print("  %-10s %-5s min=%.3fs median=%.3fs max=%.3fs "
+                  "recovered=%.3fs (%d windows)" % (
+                      e['endpoint'], e['mode'], e['min'], e['median'],
+                      e['max'], e['recovered'], e['windows']
+                  ))
+    verified = [
+        w['server_duration'] for w in windows
+        if w.get('server_duration') is not None
+    ]
+    if verified:
+        print("Server side downtime: min=%.3fs median=%.3fs max=%.3fs" % (
+            min(verified), statistics.median(verified), max(verified)
+        ))
+    phases = phases_summary(probes)
+    for phase in PHASES:
+        if phase in phases:
+            print("  %-15s min=%.3fs median=%.3fs max=%.3fs" % (
+                phase, phases[phase]['min'], phases[phase]['median'],
+                phases[phase]['max']
+            ))
+
+    if env.output:
+        with open(env.output, 'w') as f:
+            json.dump({
+                'timestamp': dt.utcnow().isoformat(),
+                'traffic': env.traffic,
+                'dbt2_terminals': env.terminal if env.traffic else 0,
+                'endpoints': [name for (name, pg) in endpoints],
+                'probes': env.probes,
+                'read_probes': env.read_probes,
+                'rate': env.rate,
+                'downtime': downtime['max'] if downtime else 0,
+                'downtime_min': downtime['min'] if downtime else 0,
+                'downtime_median': downtime['median'] if downtime else 0,
+                'windows': windows,
+                'endpoints_windows': per_endpoint,
+                'phases': phases,
+                'outages': [
+                    dict(o, probe=p.probe_id, endpoint=p.endpoint,
+                         mode=p.mode)
+                    for p in probes for o in p.outages
+                ],
+            }, f, indent=2)
 
     # Stop the DBT2 processes
     if driver:
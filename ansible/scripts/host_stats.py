@@ -0,0 +1,314 @@
+"""
+Host resource telemetry
+
+Run as an agent, this script samples the system counters of the host it runs
+on every --interval seconds and writes them on its standard output, one JSON
+document per line:
+- /proc/stat: CPU time counters, in clock ticks
+- /proc/diskstats: read and write operations, sectors and I/O time of the
+  block devices (partitions excluded), and /sys/block: how they are stacked
+  (LVM or MD devices built on top of physical disks)
+- /proc/net/dev: received and transmitted bytes of the network interfaces
+  (loopback excluded)
+- /proc/meminfo: total and available memory
+
+The agent needs Python 3 only and can be executed on a remote host through
+SSH without being installed there:
+
+$ ssh bdr1 python3 - --interval 1 < ./host_stats.py
+
+The Agent class starts and reads the agents, locally or through SSH, and
+aggregates the samples received during a time window.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# Fields of the cpu line of /proc/stat
+CPU_FIELDS = (
+    'user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal'
+)
+# Sector size used by /proc/diskstats
+SECTOR_SIZE = 512
+# Block devices not worth reporting
+IGNORED_DISKS = ('loop', 'ram', 'zram', 'sr')
+# Aggregated metrics, in this order
+METRICS = (
+    'cpu_busy', 'cpu_busy_max', 'cpu_iowait', 'cpu_steal', 'disk_util',
+    'disk_read_mbps', 'disk_write_mbps', 'disk_iops', 'net_rx_mbps',
+    'net_tx_mbps', 'mem_used_pct',
+)
+
+
+def read_cpu():
+    with open('/proc/stat') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] == 'cpu':
+                values = [int(v) for v in fields[1:len(CPU_FIELDS) + 1]]
+                return values + [0] * (len(CPU_FIELDS) - len(values))
+    return [0] * len(CPU_FIELDS)
+
+
+def read_disks():
+    """
+    Returns (reads, sectors read, writes, sectors written, I/O ms) per block
+    device
+    """
+    devices = set(os.listdir('/sys/block'))
+    disks = {}
+    with open('/proc/diskstats') as f:
+        for line in f:
+            fields = line.split()
+            name = fields[2]
+            if name not in devices or name.startswith(IGNORED_DISKS):
+                continue
+            disks[name] = [
+                int(fields[3]), int(fields[5]), int(fields[7]),
+                int(fields[9]), int(fields[12])
+            ]
+    return disks
+
+
+def read_disk_layers():
+    """
+    Returns the list of the block devices having holders (devices used by
+    LVM or MD devices), and the list of the block devices having slaves
+    (LVM or MD devices)
+    """
+    held = []
+    stacked = []
+    for name in os.listdir('/sys/block'):
+        if name.startswith(IGNORED_DISKS):
+            continue
+        if os.listdir(os.path.join('/sys/block', name, 'holders')):
+            held.append(name)
+        if os.listdir(os.path.join('/sys/block', name, 'slaves')):
+            stacked.append(name)
+    return (held, stacked)
+
+
+def read_nets():
+    """
+    Returns (received bytes, transmitted bytes) per network interface
+    """
+    nets = {}
+    with open('/proc/net/dev') as f:
+        for line in f:
+            if ':' not in line:
+                # Headers
+                continue
+            (name, data) = line.split(':', 1)
+            name = name.strip()
+            if name == 'lo':
+                continue
+            fields = data.split()
+            nets[name] = [int(fields[0]), int(fields[8])]
+    return nets
+
+
+def read_mem():
+    """
+    Returns total and available memory in kB
+    """
+    mem = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            (key, value) = line.split(':', 1)
+            mem[key] = int(value.split()[0])
+    return [mem['MemTotal'], mem.get('MemAvailable', mem['MemFree'])]
+
+
+def read_counters():
+    (held, stacked) = read_disk_layers()
+    return {
+        'time': time.monotonic(),
+        'cpu': read_cpu(),
+        'disks': read_disks(),
+        'held_disks': held,
+        'stacked_disks': stacked,
+        'nets': read_nets(),
+        'mem': read_mem(),
+    }
+
+
+def aggregate(samples):
+    """
+    Aggregates a list of consecutive counter samples into a dict of metrics:
+    CPU usage in %, utilization of the busiest physical disk in %, disk and
+    network throughput in MB/s, disk IOPS and peak memory usage in %. Disk
+    throughput and IOPS are those of the top level devices: I/Os on LVM or MD
+    devices are not counted again on the disks below them.
+    """
+    if len(samples) < 2:
+        return {}
+    first = samples[0]
+    last = samples[-1]
+    elapsed = last['time'] - first['time']
+    if elapsed <= 0:
+        return {}
+
+    def cpu_ratio(a, b, fields):
+        delta = [y - x for (x, y) in zip(a['cpu'], b['cpu'])]
+        total = sum(delta)
+        if total <= 0:
+            return 0.0
+        return 100.0 * sum(
+            delta[CPU_FIELDS.index(f)] for f in fields
+        ) / total
+
+    busy = [f for f in CPU_FIELDS if f not in ('idle', 'iowait')]
+    m = {}
+    m['cpu_busy'] = cpu_ratio(first, last, busy)
+    m['cpu_busy_max'] = max(
+        cpu_ratio(a, b, busy) for (a, b) in zip(samples, samples[1:])
+    )
+    m['cpu_iowait'] = cpu_ratio(first, last, ['iowait'])
+    m['cpu_steal'] = cpu_ratio(first, last, ['steal'])
+
+    disks = dict(
+        (d, [y - x for (x, y) in zip(first['disks'][d], last['disks'][d])])
+        for d in last['disks'] if d in first['disks']
+    )
+    held = last.get('held_disks', [])
+    stacked = last.get('stacked_disks', [])
+    physical = [v for (d, v) in disks.items() if d not in stacked]
+    top = [v for (d, v) in disks.items() if d not in held]
+    m['disk_util'] = max(
+        [100.0 * d[4] / 1000 / elapsed for d in physical] or [0.0]
+    )
+    m['disk_read_mbps'] = \
+        sum(d[1] for d in top) * SECTOR_SIZE / 1024.0 ** 2 / elapsed
+    m['disk_write_mbps'] = \
+        sum(d[3] for d in top) * SECTOR_SIZE / 1024.0 ** 2 / elapsed
+    m['disk_iops'] = sum(d[0] + d[2] for d in top) / elapsed
+
+    nets = [
+        [y - x for (x, y) in zip(first['nets'][n], last['nets'][n])]
+        for n in last['nets'] if n in first['nets']
+    ]
+    m['net_rx_mbps'] = sum(n[0] for n in nets) / 1024.0 ** 2 / elapsed
+    m['net_tx_mbps'] = sum(n[1] for n in nets) / 1024.0 ** 2 / elapsed
+
+    m['mem_used_pct'] = max(
+        100.0 * (s['mem'][0] - s['mem'][1]) / s['mem'][0] for s in samples
+    )
+    return m
+
+
+class Agent(object):
+    """
+    Runs the telemetry agent on a host, through SSH, or locally when the host
+    is 'local'. The samples are timestamped with the local monotonic clock
+    when they are received. The error output of the agent is kept to report
+    why it died.
+    """
+
+    def __init__(self, host, interval):
+        self.host = host
+        self.samples = []
+        self.lock = threading.Lock()
+        args = ['python3', '-', '--interval', str(interval)]
+        if host == 'local':
+            cmd = [sys.executable] + args[1:]
+        else:
+            cmd = ['ssh', host] + args
+        self.stderr = tempfile.TemporaryFile(mode='w+')
+        with open(os.path.abspath(__file__)) as script:
+            self.process = subprocess.Popen(
+                cmd,
+                stdin=script,
+                stdout=subprocess.PIPE,
+                stderr=self.stderr,
+                universal_newlines=True,
+                start_new_session=True,
+            )
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        for line in self.process.stdout:
+            try:
+                sample = json.loads(line)
+            except ValueError:
+                continue
+            sample['time'] = time.monotonic()
+            with self.lock:
+                self.samples.append(sample)
+
+    def window(self, start, end):
+        """
+        Returns the aggregated metrics of the [start, end] time window. The
+        last sample received before start is used as the baseline. Older
+        samples are discarded.
+        """
+        with self.lock:
+            before = [i for (i, s) in enumerate(self.samples)
+                      if s['time'] < start]
+            first = before[-1] if before else 0
+            self.samples = self.samples[first:]
+            samples = [s for s in self.samples if s['time'] <= end]
+        return aggregate(samples)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    @property
+    def error(self):
+        """
+        Returns why the agent died, or None when it is running
+        """
+        if self.alive():
+            return None
+        self.stderr.seek(0)
+        return "exit code %s: %s" % (
+            self.process.returncode, self.stderr.read().strip()
+        )
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.stderr.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sample the host resource counters."
+    )
+    parser.add_argument(
+        '--interval', '-i',
+        dest='interval',
+        type=float,
+        help="Sampling interval in seconds. Default: %(default)s",
+        default=1,
+    )
+    env = parser.parse_args()
+
+    next_tick = time.monotonic()
+    try:
+        while True:
+            counters = read_counters()
+            del counters['time']
+            sys.stdout.write("%s\n" % json.dumps(counters))
+            sys.stdout.flush()
+            next_tick += env.interval
+            time.sleep(max(0, next_tick - time.monotonic()))
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Offline analyzer for the lag/TPS traces produced by monitor_lag.py
+
+Trace files, CSV or binary, are read by chunks of samples and each chunk is
+processed with NumPy: memory usage does not depend on the trace size. For each
+replication lag column, the following are computed:
+- lag percentiles, based on a log-scaled histogram
+- catchup rate: bytes/s drained while the lag decreases
+- time spent above the lag thresholds
+- correlation between the node TPS and the lag growth rate
+- mean and max lag, and mean TPS, over fixed time windows
+
+The summary is written in CSV format on the standard output. Window statistics
+are written to a separate CSV file with the --windows option.
+
+Ex:
+
+$ python3 ./lag_analyzer.py -t 16MB -t 1GB -W 60 --windows /tmp/windows.csv /tmp/output.bin.20220519-071500.000000 /tmp/output.bin
+"""
+
+import argparse
+import sys
+import zlib
+
+import numpy as np
+
+from lag_output import CSVSink, read_chunks
+
+
+# Number of samples per chunk, for CSV files
+CHUNK_SIZE = 65536
+# Lag histogram bin edges: 0, then from 1 byte to 100TB, 20 bins per decade
+LAG_BINS = np.concatenate(([0.0], np.logspace(0, 14, 14 * 20 + 1)))
+PERCENTILES = (50, 90, 99, 99.9)
+
+UNITS = {
+    '': 1,
+    'B': 1,
+    'KB': 1024,
+    'MB': 1024 ** 2,
+    'GB': 1024 ** 3,
+    'TB': 1024 ** 4,
+}
+
+
+def size_type(value):
+    """
+    Parse a size in bytes, with an optional unit: 16MB, 1GB, etc..
+    """
+    v = value.strip().upper()
+    n = v.rstrip('KMGTB')
+    try:
+        return int(float(n) * UNITS[v[len(n):]])
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError("invalid size: %s" % value)
+
+
+def to_float(values):
+    """
+    Convert a column of strings to a float array, empty values becoming NaN
+    """
+    a = np.array(values)
+    return np.where(a == '', 'nan', a).astype(float)
+
+
+def to_seconds(values):
+    """
+    Convert a column of timestamps to a float array of seconds since epoch
+    """
+    return np.array(values, dtype='datetime64[us]').astype('int64') / 1e6
+
+
+def tps_column(header, lag_column):
+    """
+    Returns the TPS column of the node owning the replication lag column:
+    'tps' for single node traces, '<node>_tps' for --all-nodes traces.
+    """
+    candidates = [
+        c for c in header
+        if c.endswith('tps') and lag_column.startswith(c[:-len('tps')])
+    ]
+    return max(candidates, key=len) if candidates else None
+
+
+class LagStats(object):
+    """
+    Streaming statistics of one replication lag column
+    """
+
+    def __init__(self, thresholds):
+        self.thresholds = np.array(thresholds, dtype=float)
+        self.hist = np.zeros(len(LAG_BINS) + 1, dtype='int64')
+        self.count = 0
+        self.max = 0.0
+        self.above = np.zeros(len(thresholds))
+        self.drained = 0.0
+        self.drain_time = 0.0
+        self.max_drain_rate = 0.0
+        # Sums used for the correlation between TPS and lag growth rate
+        self.corr = np.zeros(6)
+        # Last sample of the previous chunk
+        self.last_t = np.nan
+        self.last_lag = np.nan
+
+    def update(self, t, lag, tps):
+        valid = ~np.isnan(lag)
+        if valid.any():
+            idx = np.searchsorted(LAG_BINS, lag[valid], side='right')
+            self.hist += np.bincount(idx, minlength=len(self.hist))
+            self.count += int(valid.sum())
+            self.max = max(self.max, float(lag[valid].max()))
+
+        # Deltas between consecutive samples, including the last sample of
+        # the previous chunk
+        t2 = np.concatenate(([self.last_t], t))
+        lag2 = np.concatenate(([self.last_lag], lag))
+        dt = np.diff(t2)
+        dlag = np.diff(lag2)
+        ok = (dt > 0) & ~np.isnan(dlag)
+        self.last_t = t[-1]
+        self.last_lag = lag[-1]
+        if not ok.any():
+            return
+        dt = dt[ok]
+        dlag = dlag[ok]
+        end_lag = lag2[1:][ok]
+
+        # Time above thresholds: each interval is accounted depending on the
+        # lag at its end
+        self.above += (
+            (end_lag[:, None] > self.thresholds[None, :]) * dt[:, None]
+        ).sum(axis=0)
+
+        # Catchup rate
+        draining = dlag < 0
+        if draining.any():
+            self.drained -= dlag[draining].sum()
+            self.drain_time += dt[draining].sum()
+            self.max_drain_rate = max(
+                self.max_drain_rate, float((-dlag / dt)[draining].max())
+            )
+
+        # TPS vs lag growth rate
+        if tps is not None:
+            x = tps[ok]
+            y = dlag / dt
+            both = ~np.isnan(x)
+            x = x[both]
+            y = y[both]
+            self.corr += np.array([
+                len(x), x.sum(), y.sum(), (x * y).sum(), (x * x).sum(),
+                (y * y).sum()
+            ])
+
+    def percentile(self, p):
+        if self.count == 0:
+            return np.nan
+        cumul = np.cumsum(self.hist)
+        k = int(np.searchsorted(cumul, self.count * p / 100.0))
+        # Upper edge of the bin, bounded by the max value
+        return min(LAG_BINS[min(k, len(LAG_BINS) - 1)], self.max)
+
+    def correlation(self):
+        (n, sx, sy, sxy, sxx, syy) = self.corr
+        if n < 2:
+            return np.nan
+        cov = n * sxy - sx * sy
+        var = (n * sxx - sx * sx) * (n * syy - sy * sy)
+        return cov / np.sqrt(var) if var > 0 else np.nan
+
+    def summary(self):
+        values = [self.count]
+        values += [self.percentile(p) for p in PERCENTILES]
+        values.append(self.max)
+        values.append(
+            self.drained / self.drain_time if self.drain_time > 0 else np.nan
+        )
+        values.append(self.max_drain_rate)
+        values += list(self.above)
+        values.append(self.correlation())
+        return values
+
+
+class WindowStats(object):
+    """
+    Mean and max values of the columns over fixed time windows, written to a
+    CSV file. A new schema is written when the columns change.
+    """
+
+    def __init__(self, width, sink):
+        self.width = width
+        self.sink = sink
+        self.columns = None
+        self.window = None
+        self.sums = None
+        self.counts = None
+        self.maxs = None
+
+    def update(self, t, columns, values):
+        if columns != self.columns:
+            self.flush()
+            self.columns = columns
+            header = ['window_start']
+            for c in columns:
+                header += ['%s_mean' % c, '%s_max' % c]
+            self.sink.write_header(header)
+
+        # Window number of each sample, and boundaries of each window in the
+        # chunk
+        wid = np.floor(t / self.width).astype('int64')
+        (windows, starts) = np.unique(wid, return_index=True)
+        valid = ~np.isnan(values)
+        zeros = np.where(valid, values, 0.0)
+        sums = np.add.reduceat(zeros, starts, axis=0)
+        counts = np.add.reduceat(valid.astype('int64'), starts, axis=0)
+        maxs = np.maximum.reduceat(
+            np.where(valid, values, -np.inf), starts, axis=0
+        )
+
+        for (i, w) in enumerate(windows):
+            if w == self.window:
+                # Window started in the previous chunk
+                self.sums += sums[i]
+                self.counts += counts[i]
+                self.maxs = np.maximum(self.maxs, maxs[i])
+                continue
+            self.flush()
+            self.window = w
+            self.sums = sums[i]
+            self.counts = counts[i]
+            self.maxs = maxs[i]
+
+    def flush(self):
+        if self.window is None:
+            return
+        line = [
+            str(np.datetime64(int(self.window * self.width * 1e6), 'us'))
+            .replace('T', ' ')
+        ]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sums / self.counts
+        for (mean, m) in zip(means, self.maxs):
+            line.append('' if np.isnan(mean) else '%f' % mean)
+            line.append('' if np.isinf(m) else '%f' % m)
+        self.sink.write(line)
+        self.window = None
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+
+def analyze(paths, thresholds, windows=None):
+    """
+    Returns a dict of LagStats, per replication lag column
+    """
+    stats = {}
+    for path in paths:
+        for (_, header, columns) in read_chunks(path, CHUNK_SIZE):
+            data = dict(zip(header, columns))
+            t = to_seconds(data['timestamp'])
+            tps = {}
+            for c in stats:
+                if c not in data:
+                    # Column removed: do not compute deltas across the gap
+                    stats[c].last_t = np.nan
+            for c in header:
+                if not c.endswith('_lag_bytes'):
+                    continue
+                tc = tps_column(header, c)
+                if tc is not None and tc not in tps:
+                    tps[tc] = to_float(data[tc])
+                if c not in stats:
+                    stats[c] = LagStats(thresholds)
+                stats[c].update(t, to_float(data[c]), tps.get(tc))
+            if windows is not None:
+                names = sorted(tps) + [
+                    c for c in header if c.endswith('_lag_bytes')
+                ]
+                values = np.column_stack(
+                    [tps[c] if c in tps else to_float(data[c]) for c in names]
+                )
+                windows.update(t, names, values)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze monitor_lag.py output files."
+    )
+    parser.add_argument(
+        'inputs',
+        type=str,
+        nargs='+',
+        help="Input files, CSV or binary, in chronological order.",
+    )
+    parser.add_argument(
+        '--threshold', '-t',
+        dest='thresholds',
+        type=size_type,
+        action='append',
+        help="Lag threshold, accepts units: kB, MB, GB, TB. Can be used "
+             "multiple times. Default: 16MB and 1GB",
+    )
+    parser.add_argument(
+        '--window', '-W',
+        dest='window',
+        type=float,
+        help="Window width in seconds. Default: %(default)s",
+        default=60,
+    )
+    parser.add_argument(
+        '--windows',
+        dest='windows',
+        type=str,
+        help="Window statistics CSV output file.",
+    )
+    env = parser.parse_args()
+
+    thresholds = env.thresholds or [16 * 1024 ** 2, 1024 ** 3]
+    windows = None
+    if env.windows:
+        windows = WindowStats(env.window, CSVSink(env.windows))
+
+    try:
+        stats = analyze(env.inputs, thresholds, windows)
+    except (OSError, ValueError, KeyError, zlib.error) as e:
+        sys.exit("Unable to analyze: %s" % e)
+    finally:
+        if windows is not None:
+            windows.close()
+
+    header = ['column', 'samples']
+    header += ['p%s_lag_bytes' % p for p in PERCENTILES]
+    header += ['max_lag_bytes', 'catchup_rate', 'max_catchup_rate']
+    header += ['time_above_%d' % th for th in thresholds]
+    header.append('tps_lag_growth_corr')
+    print(','.join(header))
+    for c in sorted(stats):
+        print(','.join([c] + [str(v) for v in stats[c].summary()]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""
+Output sinks for the samples produced by monitor_lag.py
+
+Two output formats are supported:
+- csv: ';' separated text lines, one line per tick, the first line containing
+  the column headers.
+- binary: a magic string followed by a sequence of frames. Each frame starts
+  with its type (1 byte) and its payload length (unsigned 4 bytes integer, big
+  endian). 'S' frames contain the schema version (unsigned 4 bytes integer)
+  followed by the ';' separated column headers, 'C' frames contain a zlib
+  compressed chunk of samples stored column by column.
+
+The list of columns changes when a BDR node joins or parts the cluster. Each
+new list of columns gets a new schema version: in CSV files, a '#schema;<N>'
+line is written, followed by the new column headers. In binary files, a new
+'S' frame is written. When samples are appended to an existing output file,
+schema versions follow the last one found in the file, and a new schema is
+written if the column headers differ.
+
+The output file is kept opened and samples are buffered: data are flushed, and
+optionally fsynced, every flush_interval seconds. The output file can be
+rotated depending on its size or age: the current file is renamed with a
+timestamp suffix and a new one is started. Each file starts with the current
+schema.
+
+Output files, CSV or binary, can be merged and converted to CSV:
+
+$ python ./lag_output.py -o /tmp/output.csv /tmp/output.bin.20220519-071500.000000 /tmp/output.bin
+"""
+
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime
+
+
+MAGIC = b'BDRLAG1\n'
+# Frame type and payload length
+FRAME = struct.Struct('>cI')
+# Number of rows in a chunk
+ROW_COUNT = struct.Struct('>I')
+# Schema version
+SCHEMA_VERSION = struct.Struct('>I')
+
+FRAME_SCHEMA = b'S'
+FRAME_CHUNK = b'C'
+
+# CSV schema record prefix
+CSV_SCHEMA = '#schema'
+
+# Write buffer size
+BUFFER_SIZE = 1024 * 1024
+# Maximum number of samples per binary chunk
+CHUNK_ROWS = 1024
+
+
+class Sink(object):
+    """
+    Base output sink: keeps the output file opened, flushes it periodically
+    and takes care of the rotation.
+    """
+
+    mode = None
+
+    def __init__(self, path, flush_interval=5, fsync=False, rotate_size=None,
+                 rotate_time=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.header = None
+        self.version = 0
+        # Whether the samples continue the last schema of an existing file
+        self.continued = False
+        self.f = None
+        self.opened_at = None
+        self.last_flush = None
+
+    def open(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.continued = False
+        if not new:
+            (version, header) = self.last_schema()
+            if version is not None:
+                self.continued = header == self.header
+                self.version = version if self.continued else version + 1
+        self.f = open(self.path, self.mode, buffering=BUFFER_SIZE)
+        self.opened_at = time.monotonic()
+        self.last_flush = self.opened_at
+        self.start_segment(new)
+
+    def write_header(self, header):
+        """
+        Set the column headers. A new schema version is written when they
+        differ from the current ones.
+        """
+        if header == self.header:
+            return
+        self.header = header
+        self.version += 1
+        if self.f is None:
+            self.open()
+        else:
+            # Samples of the previous schema must be written first
+            self.flush_buffer()
+            self.write_schema()
+
+    def write(self, line):
+        self.write_line(line)
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+            if self.must_rotate(now):
+                self.rotate()
+
+    def flush(self):
+        self.flush_buffer()
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+        self.last_flush = time.monotonic()
+
+    def must_rotate(self, now):
+        if self.rotate_size and self.f.tell() >= self.rotate_size:
+            return True
+        if self.rotate_time and now - self.opened_at >= self.rotate_time:
+            return True
+        return False
+
+    def rotate(self):
+        self.f.close()
+        os.rename(
+            self.path,
+            '%s.%s' % (self.path, datetime.now().strftime('%Y%m%d-%H%M%S.%f'))
+        )
+        self.open()
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        self.f.close()
+        self.f = None
+
+    def last_schema(self):
+        """
+        Returns the last (version, header) of the existing output file
+        """
+        raise NotImplementedError
+
+    def start_segment(self, new):
+        raise NotImplementedError
+
+    def write_schema(self):
+        raise NotImplementedError
+
+    def write_line(self, line):
+        raise NotImplementedError
+
+    def flush_buffer(self):
+        pass
+
+
+class CSVSink(Sink):
+
+    mode = 'a'
+
+    def last_schema(self):
+        version = None
+        header = None
+        with open(self.path, 'r') as f:
+            for (version, header) in read_csv_schemas(f):
+                pass
+        return (version, header)
+
+    def start_segment(self, new):
+        if self.continued:
+            # Appending to an existing file with the same column headers
+            return
+        if self.version > 1 or not new:
+            self.write_schema()
+        else:
+            self.write_line(self.header)
+
+    def write_schema(self):
+        self.write_line([CSV_SCHEMA, str(self.version)])
+        self.write_line(self.header)
+
+    def write_line(self, line):
+        self.f.write("%s\n" % ';'.join(line))
+
+
+class BinarySink(Sink):
+
+    mode = 'ab'
+
+    def __init__(self, *args, **kwargs):
+        super(BinarySink, self).__init__(*args, **kwargs)
+        self.rows = []
+
+    def last_schema(self):
+        version = None
+        header = None
+        # Frames appended to a file that is not a binary one could not be
+        # read back: ValueError is raised
+        with open(self.path, 'rb') as f:
+            for (frame_type, payload) in read_frames(f):
+                if frame_type == FRAME_SCHEMA:
+                    (version, header) = decode_schema(payload)
+        return (version, header)
+
+    def start_segment(self, new):
+        if new:
+            self.f.write(MAGIC)
+        # Each segment is self-describing
+        self.write_schema()
+
+    def write_schema(self):
+        self.write_frame(
+            FRAME_SCHEMA,
+            SCHEMA_VERSION.pack(self.version)
+            + ';'.join(self.header).encode('utf-8')
+        )
+
+    def write_line(self, line):
+        self.rows.append(line)
+        if len(self.rows) >= CHUNK_ROWS:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        if not self.rows:
+            return
+        self.write_frame(FRAME_CHUNK, encode_chunk(self.rows))
+        self.rows = []
+
+    def write_frame(self, frame_type, payload):
+        self.f.write(FRAME.pack(frame_type, len(payload)))
+        self.f.write(payload)
+
+
+SINKS = {
+    'csv': CSVSink,
+    'binary': BinarySink,
+}
+
+
+def encode_chunk(rows):
+    """
+    Compress a list of rows, storing values column by column
+    """
+    columns = [
+        '\n'.join(values).encode('utf-8') for values in zip(*rows)
+    ]
+    return ROW_COUNT.pack(len(rows)) + zlib.compress(b'\0'.join(columns))
+
+
+def decode_columns(payload):
+    """
+    Returns the list of columns stored in a chunk
+    """
+    (n,) = ROW_COUNT.unpack_from(payload)
+    data = zlib.decompress(payload[ROW_COUNT.size:]).decode('utf-8')
+    columns = [c.split('\n') for c in data.split('\0')]
+    for values in columns:
+        if len(values) != n:
+            raise ValueError("Corrupted chunk")
+    return columns
+
+
+def decode_chunk(payload):
+    """
+    Returns the list of rows stored in a chunk
+    """
+    return [list(r) for r in zip(*decode_columns(payload))]
+
+
+def decode_schema(payload):
+    """
+    Returns the version and the column headers stored in a schema frame
+    """
+    (version,) = SCHEMA_VERSION.unpack_from(payload)
+    return (version, payload[SCHEMA_VERSION.size:].decode('utf-8').split(';'))
+
+
+def read_frames(f):
+    """
+    Generator reading the frames of a binary file, yielding (type, payload)
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a binary lag samples file")
+    while True:
+        data = f.read(FRAME.size)
+        if len(data) < FRAME.size:
+            # End of file, or truncated frame header
+            return
+        (frame_type, length) = FRAME.unpack(data)
+        payload = f.read(length)
+        if len(payload) < length:
+            # Truncated frame: the writer has been interrupted
+            return
+        yield (frame_type, payload)
+
+
+def read_binary(f):
+    """
+    Generator yielding (version, header, row) for each sample of a binary file
+    """
+    version = None
+    header = None
+    for (frame_type, payload) in read_frames(f):
+        if frame_type == FRAME_SCHEMA:
+            (version, header) = decode_schema(payload)
+        elif frame_type == FRAME_CHUNK:
+            for row in decode_chunk(payload):
+                yield (version, header, row)
+
+
+def read_csv_schemas(f):
+    """
+    Generator yielding (version, header) for each schema of a CSV file
+    """
+    version = 1
+    expect_header = True
+    for line in f:
+        row = line.rstrip('\n').split(';')
+        if row[0] == CSV_SCHEMA:
+            version = int(row[1])
+            expect_header = True
+        elif expect_header:
+            expect_header = False
+            yield (version, row)
+
+
+def read_csv(f):
+    """
+    Generator yielding (version, header, row) for each sample of a CSV file
+    """
+    version = 1
+    header = None
+    for line in f:
+        row = line.rstrip('\n').split(';')
+        if row[0] == CSV_SCHEMA:
+            version = int(row[1])
+            header = None
+        elif header is None:
+            header = row
+        else:
+            yield (version, header, row)
+
+
+def read_samples(path):
+    """
+    Generator yielding (version, header, row) for each sample of an output
+    file, CSV or binary
+    """
+    with open(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        with open(path, 'rb') as f:
+            for sample in read_binary(f):
+                yield sample
+    else:
+        with open(path, 'r') as f:
+            for sample in read_csv(f):
+                yield sample
+
+
+def read_chunks(path, size=CHUNK_ROWS):
+    """
+    Generator yielding (version, header, columns) for chunks of samples of an
+    output file, CSV or binary. All the samples of a chunk share the same
+    schema. Binary chunks are returned as they are stored, CSV samples are
+    grouped by chunks of size rows.
+    """
+    with open(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        version = None
+        header = None
+        with open(path, 'rb') as f:
+            for (frame_type, payload) in read_frames(f):
+                if frame_type == FRAME_SCHEMA:
+                    (version, header) = decode_schema(payload)
+                elif frame_type == FRAME_CHUNK:
+                    yield (version, header, decode_columns(payload))
+        return
+
+    rows = []
+    current = None
+    for (version, header, row) in read_samples(path):
+        if len(row) != len(header):
+            # Partially written line
+            continue
+        if rows and (len(rows) >= size or current[1] is not header):
+            yield (current[0], current[1], [list(c) for c in zip(*rows)])
+            rows = []
+        current = (version, header)
+        rows.append(row)
+    if rows:
+        yield (current[0], current[1], [list(c) for c in zip(*rows)])
+
+
+def merge_to_csv(paths, out):
+    """
+    Merge output files, in this order, into one CSV stream. A schema record is
+    written each time the column headers change.
+    """
+    header = None
+    version = 0
+    for path in paths:
+        for (_, h, row) in read_samples(path):
+            if h != header:
+                header = h
+                version += 1
+                if version > 1:
+                    out.write("%s;%d\n" % (CSV_SCHEMA, version))
+                out.write("%s\n" % ';'.join(header))
+            out.write("%s\n" % ';'.join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge monitor_lag.py output files and convert them to "
+                    "CSV."
+    )
+    parser.add_argument(
+        'inputs',
+        type=str,
+        nargs='+',
+        help="Input files, CSV or binary, in chronological order.",
+    )
+    parser.add_argument(
+        '--output', '-o',
+        dest='output',
+        type=str,
+        help="CSV output file. Default: standard output",
+    )
+    env = parser.parse_args()
+
+    try:
+        if env.output:
+            with open(env.output, 'w') as out:
+                merge_to_csv(env.inputs, out)
+        else:
+            merge_to_csv(env.inputs, sys.stdout)
+    except (OSError, ValueError, zlib.error) as e:
+        sys.exit("Unable to convert: %s" % e)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,103 @@ Replication lag monitoring script for BDR cluster producing CSV output
 Ex:
 
 $ sudo -u enterprisedb python ./monit_tps_replication_lag.py  "host=/tmp dbname=bdrdb" /tmp/output.csv
+
+With the --all-nodes option, the BDR nodes are discovered from the
+bdr.node_summary catalog view and all of them are sampled concurrently, on the
+same clock tick, producing one combined line per tick:
+
+$ sudo -u enterprisedb python ./monit_tps_replication_lag.py --all-nodes "host=/tmp dbname=bdrdb" /tmp/output.csv
+
+Samples can be written in a compressed binary format, with rotation of the
+output file every 100MB; see lag_output.py for the conversion back to CSV:
+
+$ sudo -u enterprisedb python ./monit_tps_replication_lag.py -f binary --rotate-size 100 "host=/tmp dbname=bdrdb" /tmp/output.bin
+
+Metrics can also be exposed in the OpenMetrics format, on
+http://<host>:9187/metrics, instead of being written to an output file:
+
+$ sudo -u enterprisedb python ./monit_tps_replication_lag.py --all-nodes -i 5 -l :9187 "host=/tmp dbname=bdrdb"
+
+The catchup time waits for the peers to replay the current WAL location, it
+is sampled by a separate thread every --catchup-interval seconds, so the other
+metrics keep the sampling interval while the lag is high:
+
+$ sudo -u enterprisedb python ./monit_tps_replication_lag.py --all-nodes -i 0.1 --catchup-interval 10 "host=/tmp dbname=bdrdb" /tmp/output.csv
 """
 
+import argparse
 import glob
 import os
 import psycopg2
+import signal
 import sys
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from lag_output import SINKS
+
+
+# Sampling query, prepared once per connection
+SAMPLE_QUERY = """
+    PREPARE bdr_monitor_sample AS
+    SELECT
+        now() AS timestamp,
+        (SELECT
+            SUM(pg_stat_get_db_xact_commit(oid)+pg_stat_get_db_xact_rollback(oid))::BIGINT
+         FROM pg_database
+         WHERE datname = current_database()
+        ) AS no_xact,
+        json_object_agg(ns.target_name, ns.replay_lag_bytes) AS nodes_replay_lag_bytes,
+        pg_current_wal_lsn(),
+        pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')::BIGINT AS wal_bytes
+    FROM bdr.node_slots AS ns
+    WHERE ns.origin_name <> '' AND ns.slot_type = 'logical'
+"""
+
+# Catchup time query. bdr_monitor_repl_catchup_time() waits for the peers to
+# replay up to the current WAL location: it lasts as long as the catchup.
+CATCHUP_QUERY = """
+    SELECT ns.target_name, EXTRACT(epoch FROM ct.catchup_time)
+    FROM bdr.node_slots AS ns
+    JOIN bdr_monitor_repl_catchup_time() AS ct
+        ON ct.bdr_slot_name = ns.slot_name
+    WHERE ns.origin_name <> '' AND ns.slot_type = 'logical'
+"""
+
+# Shortest sampling interval, in seconds
+MIN_INTERVAL = 0.1
+
+OPENMETRICS_CONTENT_TYPE = \
+    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
 
-def usage():
-    sys.exit("Usage: %s \"<POSTGRESQL_CONN_STRING>\" <OUTPUT_FILE>" % sys.argv[0])
+def connect(conn_string):
+    conn = psycopg2.connect(conn_string)
+    conn.set_session(autocommit=True)
+    return conn
+
+
+def connect_node(conn_string):
+    """
+    Connect to a BDR node to sample and prepare the sampling query
+    """
+    conn = connect(conn_string)
+    try:
+        prepare_sample_query(conn)
+    except psycopg2.Error:
+        conn.close()
+        raise
+    return conn
+
+
+def prepare_sample_query(conn):
+    cur = conn.cursor()
+    cur.execute(SAMPLE_QUERY)
+    cur.close()
 
 
 def get_pg_data(conn):
@@ -28,6 +114,23 @@ def get_pg_data(conn):
     return r[0]
 
 
+def discover_nodes(conn):
+    """
+    Returns the list of (node_name, connection string) of the active BDR data
+    nodes, ordered by node name
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT node_name, interface_connstr
+        FROM bdr.node_summary
+        WHERE peer_state_name = 'ACTIVE' AND node_kind_name <> 'witness'
+        ORDER BY node_name
+    """)
+    nodes = [(r[0], r[1]) for r in cur.fetchall()]
+    cur.close()
+    return nodes
+
+
 def monitor_spill_files(pg_data):
     """
     Returns the total number and total size of .spill files found in
@@ -41,28 +144,301 @@ def monitor_spill_files(pg_data):
     return (n, s)
 
 
-def main():
+def sample_node(conn, catchup_times):
+    """
+    Execute the sampling query and return its result row, along with the last
+    catchup times measured, and the query duration in seconds:
+    (timestamp, no_xact, lag_bytes, catchup_time, lsn, query_time, wal_bytes)
+    """
+    start = time.monotonic()
+    cur = conn.cursor()
+    cur.execute("EXECUTE bdr_monitor_sample")
+    r = cur.fetchone()
+    cur.close()
+    query_time = time.monotonic() - start
+    # json_object_agg() returns NULL when there is no peer
+    return (r[0], r[1], r[2] or {}, catchup_times, r[3], query_time, r[4])
 
-    if len(sys.argv) != 3:
-        usage()
 
-    try:
-        conn = psycopg2.connect(sys.argv[1])
-        conn.set_session(autocommit=True)
-    except psycopg2.Error as e:
-        sys.exit("Unable to connect to the database")
+class CatchupSampler(object):
+    """
+    Measures the catchup time of the peers of one node every interval
+    seconds, in a thread of its own with its own connection. The last values
+    measured are kept in times.
+    """
 
-    try:
-        pg_data = get_pg_data(conn)
-    except psycopg2.Error as e:
-        sys.exit("Unable to get Postgres data directory")
+    def __init__(self, dsn, interval):
+        self.dsn = dsn
+        self.interval = interval
+        self.times = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        conn = None
+        while not self.stopped.is_set():
+            start = time.monotonic()
+            try:
+                if conn is None:
+                    conn = connect(self.dsn)
+                cur = conn.cursor()
+                cur.execute(CATCHUP_QUERY)
+                self.times = dict(
+                    (n, float(t)) for (n, t) in cur.fetchall()
+                    if t is not None
+                )
+                cur.close()
+            except psycopg2.Error as e:
+                # Retried on the next interval
+                self.times = {}
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            self.stopped.wait(
+                max(0, self.interval - (time.monotonic() - start))
+            )
+        if conn is not None:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def node_headers(prefix, peers):
+    """
+    Returns the column headers of one node's sample
+    """
+    line = []
+    line.append("%stps" % prefix)
+    for n in peers:
+        line.append("%s%s_lag_bytes" % (prefix, n))
+    for n in peers:
+        line.append("%s%s_catchup_time" % (prefix, n))
+    line.append("%sLSN" % prefix)
+    line.append("%squery_time" % prefix)
+    line.append("%swal_rate" % prefix)
+    for n in peers:
+        line.append("%s%s_apply_rate" % (prefix, n))
+    for n in peers:
+        line.append("%s%s_time_to_drain" % (prefix, n))
+    return line
+
+
+def node_rates(r, last, peers):
+    """
+    Returns the WAL generation rate, in bytes/s, and for each peer, its apply
+    rate, in bytes/s, and the estimated time to drain its lag, in seconds,
+    based on the previous sample of the same node, last. Rates are None when
+    they can't be computed, time to drain is infinite when the lag does not
+    decrease.
+    """
+    d = (r[0] - last[0]).total_seconds() if last else 0
+    if d <= 0:
+        return (None, dict((n, (None, None)) for n in peers))
+    wal_rate = (r[6] - last[6]) / d
+    rates = {}
+    for n in peers:
+        if r[2][n] is None or last[2].get(n) is None:
+            rates[n] = (None, None)
+            continue
+        # The peer consumes what has been produced minus the lag growth
+        lag_rate = (r[2][n] - last[2][n]) / d
+        apply_rate = wal_rate - lag_rate
+        if r[2][n] <= 0:
+            time_to_drain = 0.0
+        elif lag_rate < 0:
+            time_to_drain = r[2][n] / -lag_rate
+        else:
+            time_to_drain = float('inf')
+        rates[n] = (apply_rate, time_to_drain)
+    return (wal_rate, rates)
+
+
+def node_values(r, last, peers):
+    """
+    Returns the column values of one node's sample, r, based on the previous
+    sample of the same node, last, if any
+    """
+    line = []
+    # Duration ins second between each snapshot
+    d = (r[0] - last[0]).total_seconds() if last else 0
+    # TPS
+    line.append("%.2f" % ((r[1] - last[1]) / d) if d > 0 else "")
+    # Replication lag in bytes
+    for n in peers:
+        line.append("%d" % r[2][n] if r[2][n] is not None else "")
+    # Catchup time, last value measured
+    for n in peers:
+        line.append("%f" % r[3][n] if r[3].get(n) is not None else "")
+    line.append(r[4])
+    line.append("%f" % r[5])
+    # WAL generation and apply rates
+    (wal_rate, rates) = node_rates(r, last, peers)
+    line.append("%.2f" % wal_rate if wal_rate is not None else "")
+    for n in peers:
+        line.append("%.2f" % rates[n][0] if rates[n][0] is not None else "")
+    for n in peers:
+        line.append("%f" % rates[n][1] if rates[n][1] is not None else "")
+    return line
+
+
+def refresh_nodes(seed, nodes, conns):
+    """
+    Update the list of BDR nodes, nodes, and the connections to them, conns,
+    after a BDR node joined or parted the cluster. The node list is fetched
+    from any of the connected nodes, or from the seed connection string.
+    """
+    discovered = None
+    for node_name in list(conns):
+        try:
+            discovered = discover_nodes(conns[node_name])
+            break
+        except psycopg2.Error as e:
+            conns.pop(node_name).close()
+    if discovered is None:
+        try:
+            conn = connect(seed)
+            try:
+                discovered = discover_nodes(conn)
+            finally:
+                conn.close()
+        except psycopg2.Error as e:
+            # Keep the current node list, retry later
+            return
+    nodes.clear()
+    nodes.update(discovered)
+    for node_name in list(conns):
+        if node_name not in nodes:
+            conns.pop(node_name).close()
+
+
+def reconnect(nodes, conns):
+    """
+    Open the missing connections to the nodes
+    """
+    for (node_name, dsn) in nodes.items():
+        if node_name in conns:
+            continue
+        try:
+            conns[node_name] = connect_node(dsn)
+        except psycopg2.Error as e:
+            pass
+
+
+class Sampler(object):
+    """
+    Samples the BDR nodes concurrently, one worker thread per node. Nodes
+    membership and lost connections are checked every refresh_interval
+    seconds. The catchup time of each node is measured by a CatchupSampler
+    every catchup_interval seconds, or not at all if catchup_interval is 0.
+    """
+
+    def __init__(self, seed, nodes, conns, all_nodes, refresh_interval,
+                 catchup_interval=0):
+        self.seed = seed
+        self.nodes = nodes
+        self.conns = conns
+        self.all_nodes = all_nodes
+        self.refresh_interval = refresh_interval
+        self.catchup_interval = catchup_interval
+        self.last_refresh = time.monotonic()
+        self.executor = None
+        self.workers = 0
+        self.last_samples = {}
+        self.catchup_samplers = {}
+        self.refresh_catchup_samplers()
+
+    def refresh_catchup_samplers(self):
+        """
+        Start and stop the catchup samplers following the node list
+        """
+        if not self.catchup_interval:
+            return
+        for node_name in list(self.catchup_samplers):
+            if node_name not in self.nodes:
+                self.catchup_samplers.pop(node_name).stop()
+        for (node_name, dsn) in self.nodes.items():
+            if node_name not in self.catchup_samplers:
+                self.catchup_samplers[node_name] = \
+                    CatchupSampler(dsn, self.catchup_interval)
+
+    def catchup_times(self, node_name):
+        if node_name not in self.catchup_samplers:
+            return {}
+        return self.catchup_samplers[node_name].times
+
+    def sample(self):
+        """
+        Returns the list of (node_name, sample, previous sample) ordered by
+        node name
+        """
+        now = time.monotonic()
+        if now - self.last_refresh >= self.refresh_interval:
+            if self.all_nodes:
+                refresh_nodes(self.seed, self.nodes, self.conns)
+                self.refresh_catchup_samplers()
+            reconnect(self.nodes, self.conns)
+            self.last_refresh = now
 
-    last_no_xact = 0
-    snapshot_timestamp = None
-    bdr_nodes = []
+        if self.workers != max(len(self.conns), 1):
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.workers = max(len(self.conns), 1)
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = [
+            (node_name, self.executor.submit(
+                sample_node, conn, self.catchup_times(node_name)
+            ))
+            for (node_name, conn) in sorted(self.conns.items(),
+                                            key=lambda c: str(c[0]))
+        ]
+        samples = []
+        for (node_name, f) in futures:
+            try:
+                r = f.result()
+            except psycopg2.Error as e:
+                # Node parted or unreachable: its columns are removed until
+                # the connection is restored
+                self.conns.pop(node_name).close()
+                self.last_samples.pop(node_name, None)
+                continue
+            samples.append((node_name, r, self.last_samples.get(node_name)))
+            # Record some informations needed for the next sample
+            self.last_samples[node_name] = r
+        return samples
 
-    output = sys.argv[2]
-    output_exists = os.path.exists(output)
+
+def wait_next_tick(deadline, interval):
+    """
+    Sleep until the next sampling deadline. Deadlines are fixed multiples of
+    the interval on the monotonic clock, so the sampling period does not
+    drift. Returns the new deadline and the number of deadlines skipped because
+    the previous tick overran.
+    """
+    deadline += interval
+    now = time.monotonic()
+    skipped = 0
+    if now >= deadline:
+        skipped = int((now - deadline) // interval) + 1
+        deadline += skipped * interval
+    time.sleep(deadline - now)
+    return (deadline, skipped)
+
+
+def interval_type(value):
+    interval = float(value)
+    if interval < MIN_INTERVAL:
+        raise argparse.ArgumentTypeError(
+            "interval must be greater than or equal to %s" % MIN_INTERVAL
+        )
+    return interval
+
+
+def monitor(sampler, pg_data, sink, interval):
+    skipped = 0
+    deadline = time.monotonic()
 
     i = 0
     while True:
@@ -70,77 +446,375 @@ def main():
         line = []
         # Starting time
         start = datetime.now()
-        # Get number and total size of .spill files
-        (sf, sf_size) = monitor_spill_files(pg_data)
-
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT
-                now() AS timestamp,
-                (SELECT
-                    SUM(pg_stat_get_db_xact_commit(oid)+pg_stat_get_db_xact_rollback(oid))::BIGINT
-                 FROM pg_database
-                 WHERE datname = current_database()
-                ) AS no_xact,
-                json_object_agg(target_name, replay_lag_bytes) AS nodes_replay_lag_bytes,
-                json_object_agg(target_name, (SELECT EXTRACT(epoch FROM ct.catchup_time) FROM bdr_monitor_repl_catchup_time() AS ct WHERE ct.bdr_slot_name=bdr.node_slots.slot_name)) AS nodes_replay_lag_bytes,
-                pg_current_wal_lsn()
-            FROM bdr.node_slots
-            WHERE origin_name <> '' AND slot_type = 'logical';
-        """)
-        r = cur.fetchone()
-        if i == 1:
-            # First iteration of the loop: just display columns headers
+        tick_start = time.monotonic()
+
+        if pg_data is not None:
+            # Get number and total size of .spill files
+            (sf, sf_size) = monitor_spill_files(pg_data)
 
+        samples = sampler.sample()
+
+        # Column headers depend on the list of nodes and peers: a new schema
+        # is written when they change.
+        header = ["timestamp"]
+        for (node_name, r, _) in samples:
             # Let sort BDR node list
-            for k in sorted(r[2]):
-                bdr_nodes.append(k)
-
-            line.append("timestamp")
-            line.append("tps")
-            for n in bdr_nodes:
-                line.append("%s_lag_bytes" % n )
-            for n in bdr_nodes:
-                line.append("%s_catchup_time" % n )
-            line.append("LSN")
-            line.append("spill_files")
-            line.append("spill_files_size")
-        else:
+            prefix = "%s_" % node_name if node_name else ""
+            header += node_headers(prefix, sorted(r[2]))
+        if pg_data is not None:
+            header.append("spill_files")
+            header.append("spill_files_size")
+        header.append("tick_duration")
+        header.append("tick_overrun")
+        header.append("skipped_ticks")
+        sink.write_header(header)
+
+        # First iteration of the loop: just display columns headers
+        if i > 1:
             # Timestamp
-            line.append(r[0].strftime("%Y-%m-%d %H:%M:%S.%f"))
-            # Duration ins second between each snapshot
-            d = (r[0] - snapshot_timestamp).total_seconds()
-            # TPS
-            line.append("%.2f" % ((r[1] - last_no_xact) / d))
-            # Replication lag in bytes
-            for n in bdr_nodes:
-                line.append("%d" % r[2][n])
-            # Catchup time
-            for n in bdr_nodes:
-                line.append("%f" % float(r[3][n]))
-            line.append(r[4])
-            # .spill files metrics
-            line.append("%s" % sf)
-            line.append("%s" % sf_size)
-
-
-        # Record some informations needed for the next loop iteration
-        snapshot_timestamp = r[0]
-        last_no_xact = r[1]
-
-        cur.close()
-
-        with open(output, 'a') as f:
-            # Do not write CSV headers if the output file already exist
-            if not (i == 1 and output_exists):
-                f.write("%s\n" % ';'.join(line))
-
-        end = datetime.now()
-        duration = (end - start).total_seconds()
-        sleep_time = 30 - duration
-        # Wait for (30 - duration) seconds until next iteration
-        if sleep_time > 0:
-            time.sleep(30 - duration)
+            if not sampler.all_nodes and samples:
+                line.append(samples[0][1][0].strftime("%Y-%m-%d %H:%M:%S.%f"))
+            else:
+                # Shared clock tick
+                line.append(start.strftime("%Y-%m-%d %H:%M:%S.%f"))
+            for (node_name, r, last) in samples:
+                line += node_values(r, last, sorted(r[2]))
+            if pg_data is not None:
+                # .spill files metrics
+                line.append("%s" % sf)
+                line.append("%s" % sf_size)
+            # Scheduling: time spent sampling, whether the tick lasted longer
+            # than the interval and how many ticks have been skipped before
+            # this one.
+            tick_duration = time.monotonic() - tick_start
+            line.append("%f" % tick_duration)
+            line.append("%d" % (tick_duration > interval))
+            line.append("%d" % skipped)
+            sink.write(line)
+
+        # Wait for the next tick
+        (deadline, skipped) = wait_next_tick(deadline, interval)
+
+
+def metric_labels(**labels):
+    """
+    Format OpenMetrics labels, skipping the ones without value
+    """
+    items = []
+    for (k, v) in sorted(labels.items()):
+        if v is None:
+            continue
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+        items.append('%s="%s"' % (k, v.replace('\n', '\\n')))
+    return '{%s}' % ','.join(items) if items else ''
+
+
+def metric_value(value):
+    """
+    Format an OpenMetrics value
+    """
+    value = float(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class Collector(object):
+    """
+    Collects the metrics exposed by the HTTP exporter. The result of a
+    collection is cached for interval seconds: concurrent scrapes share the
+    same collection and the nodes are queried at most once per interval.
+    """
+
+    def __init__(self, sampler, pg_data, interval):
+        self.sampler = sampler
+        self.pg_data = pg_data
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.collected_at = None
+        self.metrics = None
+
+    def get(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.collected_at is None \
+                    or now - self.collected_at >= self.interval:
+                self.metrics = self.collect()
+                self.collected_at = now
+            return self.metrics
+
+    def collect(self):
+        start = time.monotonic()
+        samples = self.sampler.sample()
+        metrics = {}
+
+        def add(name, mtype, description, value, **labels):
+            if name not in metrics:
+                metrics[name] = (mtype, description, [])
+            if value is not None:
+                metrics[name][2].append((labels, value))
+
+        for node_name in sorted(self.sampler.nodes, key=str):
+            add('bdr_monitor_up', 'gauge',
+                "Whether the BDR node could be sampled.",
+                int(any(s[0] == node_name for s in samples)), node=node_name)
+
+        for (node_name, r, last) in samples:
+            add('bdr_monitor_transactions', 'counter',
+                "Number of committed and rolled back transactions.",
+                r[1], node=node_name)
+            d = (r[0] - last[0]).total_seconds() if last else 0
+            if d > 0:
+                add('bdr_monitor_tps', 'gauge',
+                    "Transactions per second since the previous collection.",
+                    (r[1] - last[1]) / d, node=node_name)
+            for peer in sorted(r[2]):
+                add('bdr_monitor_replay_lag_bytes', 'gauge',
+                    "Replication lag, in bytes, of the peer node.",
+                    r[2][peer], node=node_name, peer=peer)
+                add('bdr_monitor_catchup_time_seconds', 'gauge',
+                    "Time needed by the peer node to catch up.",
+                    r[3].get(peer), node=node_name, peer=peer)
+            add('bdr_monitor_wal_lsn_bytes', 'gauge',
+                "Current WAL write location, in bytes.",
+                r[6], node=node_name)
+            (wal_rate, rates) = node_rates(r, last, sorted(r[2]))
+            add('bdr_monitor_wal_rate_bytes_per_second', 'gauge',
+                "WAL generation rate, in bytes/s, since the previous "
+                "collection.",
+                wal_rate, node=node_name)
+            for peer in sorted(rates):
+                add('bdr_monitor_apply_rate_bytes_per_second', 'gauge',
+                    "Apply rate of the peer node, in bytes/s, since the "
+                    "previous collection.",
+                    rates[peer][0], node=node_name, peer=peer)
+                add('bdr_monitor_time_to_drain_seconds', 'gauge',
+                    "Estimated time needed by the peer node to drain its "
+                    "lag.",
+                    rates[peer][1], node=node_name, peer=peer)
+            add('bdr_monitor_query_duration_seconds', 'gauge',
+                "Duration of the sampling query.",
+                r[5], node=node_name)
+
+        if self.pg_data is not None:
+            (sf, sf_size) = monitor_spill_files(self.pg_data)
+            add('bdr_monitor_spill_files', 'gauge',
+                "Number of .spill files in pg_replslot.", sf)
+            add('bdr_monitor_spill_files_bytes', 'gauge',
+                "Total size of the .spill files in pg_replslot.", sf_size)
+
+        add('bdr_monitor_collect_duration_seconds', 'gauge',
+            "Duration of the last collection.", time.monotonic() - start)
+
+        lines = []
+        for name in sorted(metrics):
+            (mtype, description, values) = metrics[name]
+            lines.append("# TYPE %s %s" % (name, mtype))
+            lines.append("# HELP %s %s" % (name, description))
+            suffix = '_total' if mtype == 'counter' else ''
+            for (labels, value) in values:
+                lines.append("%s%s%s %s" % (
+                    name, suffix, metric_labels(**labels),
+                    metric_value(value)
+                ))
+        lines.append("# EOF")
+        return "%s\n" % '\n'.join(lines)
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collector.get().encode('utf-8')
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExporterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def listen_type(value):
+    try:
+        (host, port) = value.rsplit(':', 1)
+        return (host, int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "listen address must be in the form [HOST]:PORT"
+        )
+
+
+def terminate(signum, frame):
+    # Let the output sink being flushed and closed
+    sys.exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'pg',
+        type=str,
+        help="Postgres connection string.",
+    )
+    parser.add_argument(
+        'output',
+        type=str,
+        nargs='?',
+        help="Output file.",
+    )
+    parser.add_argument(
+        '--listen', '-l',
+        dest='listen',
+        type=listen_type,
+        help="Run as an OpenMetrics exporter listening on [HOST]:PORT, "
+             "metrics are collected at most once per interval.",
+    )
+    parser.add_argument(
+        '--format', '-f',
+        dest='format',
+        choices=sorted(SINKS),
+        help="Output format. Default: %(default)s",
+        default='csv',
+    )
+    parser.add_argument(
+        '--flush-interval',
+        dest='flush_interval',
+        type=float,
+        help="Flush the output every N seconds. Default: %(default)s",
+        default=5,
+    )
+    parser.add_argument(
+        '--fsync',
+        dest='fsync',
+        action='store_true',
+        default=False,
+        help="Fsync the output file on each flush.",
+    )
+    parser.add_argument(
+        '--rotate-size',
+        dest='rotate_size',
+        type=int,
+        help="Rotate the output file once its size reaches N MB.",
+    )
+    parser.add_argument(
+        '--rotate-time',
+        dest='rotate_time',
+        type=int,
+        help="Rotate the output file every N seconds.",
+    )
+    parser.add_argument(
+        '--all-nodes', '-a',
+        dest='all_nodes',
+        action='store_true',
+        default=False,
+        help="Discover the BDR nodes and sample all of them concurrently.",
+    )
+    parser.add_argument(
+        '--interval', '-i',
+        dest='interval',
+        type=interval_type,
+        help="Sampling interval in seconds, down to %s. Default: %%(default)s"
+             % MIN_INTERVAL,
+        default=30,
+    )
+    parser.add_argument(
+        '--refresh-interval',
+        dest='refresh_interval',
+        type=float,
+        help="Check BDR nodes membership and reconnect lost nodes every N "
+             "seconds. Default: %(default)s",
+        default=60,
+    )
+    parser.add_argument(
+        '--catchup-interval',
+        dest='catchup_interval',
+        type=float,
+        help="Measure the catchup time every N seconds, in a separate "
+             "thread. 0 to disable. Default: %(default)s",
+        default=30,
+    )
+    env = parser.parse_args()
+
+    if env.output is None and env.listen is None:
+        parser.error("the output file is required")
+
+    try:
+        conn = connect(env.pg)
+    except psycopg2.Error as e:
+        sys.exit("Unable to connect to the database")
+
+    if env.all_nodes:
+        try:
+            nodes = dict(discover_nodes(conn))
+        except psycopg2.Error as e:
+            sys.exit("Unable to get BDR node list")
+        conn.close()
+        # One connection per BDR node
+        conns = {}
+        for (node_name, dsn) in nodes.items():
+            try:
+                conns[node_name] = connect_node(dsn)
+            except psycopg2.Error as e:
+                sys.exit("Unable to connect to the BDR node %s" % node_name)
+        pg_data = None
+    else:
+        nodes = {None: env.pg}
+        conns = {None: conn}
+        try:
+            pg_data = get_pg_data(conn)
+        except psycopg2.Error as e:
+            sys.exit("Unable to get Postgres data directory")
+        try:
+            prepare_sample_query(conn)
+        except psycopg2.Error as e:
+            sys.exit("Unable to prepare the sampling query")
+
+    sampler = Sampler(
+        env.pg, nodes, conns, env.all_nodes, env.refresh_interval,
+        env.catchup_interval
+    )
+    signal.signal(signal.SIGTERM, terminate)
+
+    if env.listen is not None:
+        server = ExporterServer(env.listen, ExporterHandler)
+        server.collector = Collector(sampler, pg_data, env.interval)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    sink = SINKS[env.format](
+        env.output,
+        flush_interval=env.flush_interval,
+        fsync=env.fsync,
+        rotate_size=env.rotate_size * 1024 * 1024 if env.rotate_size else None,
+        rotate_time=env.rotate_time,
+    )
+
+    try:
+        monitor(sampler, pg_data, sink, env.interval)
+    except KeyboardInterrupt:
+        pass
+    except ValueError as e:
+        # The existing output file can't be appended
+        sys.exit("Unable to write to %s: %s" % (env.output, e))
+    finally:
+        sink.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,313 @@
+"""
+Postgres profiler for the rampup steps
+
+During a step, the wait events of the active client sessions and of the BDR
+worker processes (apply, writer, ...) of each node are sampled from
+pg_stat_activity every few milliseconds. Before and after the
+step, the content of pg_stat_statements, pg_stat_bgwriter and pg_stat_wal is
+fetched on each node: the differences show what the step has consumed.
+
+From these, a per step and per node bottleneck summary is built:
+- top wait events, as a share of the active session samples ('CPU' when the
+  session is not waiting), for the client sessions and for the BDR workers
+- top statements by execution time
+- checkpoint pressure: requested checkpoints, buffers written by the backends
+- WAL write pressure: WAL throughput, full page images, WAL buffers full
+
+Statistics views not available on a node (pg_stat_wal before Postgres 14, or
+the pg_stat_statements extension not created) are skipped.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psycopg2
+
+
+# Client sessions executing a query, and BDR workers not waiting in their
+# main loop ('Activity' wait events)
+ACTIVITY_QUERY = """
+SELECT backend_type = 'client backend',
+       COALESCE(wait_event_type || ':' || wait_event, 'CPU')
+FROM pg_stat_activity
+WHERE pid <> pg_backend_pid()
+  AND ((backend_type = 'client backend' AND state = 'active')
+    OR (backend_type <> 'client backend'
+        AND (backend_type ILIKE '%bdr%' OR backend_type ILIKE '%pglogical%'
+             OR application_name ILIKE 'bdr%'
+             OR application_name ILIKE 'pglogical%')
+        AND COALESCE(state, '') <> 'idle'
+        AND wait_event_type IS DISTINCT FROM 'Activity'))
+"""
+# Views are fetched as JSON documents: columns depend on the Postgres version
+VIEW_QUERY = "SELECT to_jsonb(s) FROM %s s"
+STATEMENTS_QUERY = """
+SELECT to_jsonb(s) FROM pg_stat_statements s
+WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+"""
+# Number of entries in the summary columns
+TOP = 3
+# Number of entries in the detailed profile files
+TOP_DETAILS = 20
+# Length of the statements text in the detailed profile files
+QUERY_LENGTH = 200
+# Share of the samples above which a wait event is considered a bottleneck
+BOTTLENECK_SHARE = 0.2
+# Summary columns, per node
+COLUMNS = (
+    'active_sessions', 'top_waits', 'bdr_active_workers', 'bdr_top_waits',
+    'top_statements', 'checkpoints_req', 'buffers_backend_pct', 'wal_mbps',
+    'wal_fpi_pct', 'wal_buffers_full', 'bottleneck',
+)
+
+
+def fetch_view(conn, query):
+    """
+    Returns the rows of a statistics view as a list of dicts, or None if the
+    view is not available
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(query)
+        rows = [r[0] for r in cur.fetchall()]
+    except psycopg2.Error:
+        rows = None
+    cur.close()
+    return rows
+
+
+def diff(before, after):
+    """
+    Difference between the numeric values of two rows
+    """
+    return {
+        k: v - before.get(k, 0) for (k, v) in after.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)
+    }
+
+
+def exec_time(row):
+    # total_time was renamed to total_exec_time in Postgres 13
+    return row.get('total_exec_time', row.get('total_time', 0))
+
+
+class NodeProfiler(object):
+    """
+    Profiler of one node, keeping its own connections opened
+    """
+
+    def __init__(self, node_name, dsn, interval):
+        self.node_name = node_name
+        self.interval = interval
+        self.conn = psycopg2.connect(dsn)
+        self.conn.set_session(autocommit=True)
+        self.sampling_conn = psycopg2.connect(dsn)
+        self.sampling_conn.set_session(autocommit=True)
+        self.waits = None
+        self.bdr_waits = None
+        self.samples = 0
+        self.snapshot = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def take_snapshot(self):
+        statements = fetch_view(self.conn, STATEMENTS_QUERY)
+        bgwriter = fetch_view(self.conn, VIEW_QUERY % 'pg_stat_bgwriter')
+        wal = fetch_view(self.conn, VIEW_QUERY % 'pg_stat_wal')
+        return {
+            'time': time.monotonic(),
+            'statements': (
+                None if statements is None
+                else {(s['userid'], s['queryid']): s for s in statements}
+            ),
+            'bgwriter': bgwriter[0] if bgwriter else None,
+            'wal': wal[0] if wal else None,
+        }
+
+    def start(self):
+        self.snapshot = self.take_snapshot()
+        self.waits = {}
+        self.bdr_waits = {}
+        self.samples = 0
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        cur = self.sampling_conn.cursor()
+        next_tick = time.monotonic()
+        while not self.stopped.is_set():
+            cur.execute(ACTIVITY_QUERY)
+            for (client, event) in cur.fetchall():
+                waits = self.waits if client else self.bdr_waits
+                waits[event] = waits.get(event, 0) + 1
+            self.samples += 1
+            next_tick += self.interval
+            self.stopped.wait(max(0, next_tick - time.monotonic()))
+        cur.close()
+
+    def stop(self):
+        """
+        Stop the sampling and returns the profile of the step
+        """
+        self.stopped.set()
+        self.thread.join()
+        before = self.snapshot
+        after = self.take_snapshot()
+        elapsed = after['time'] - before['time']
+
+        profile = {
+            'elapsed': elapsed,
+            'samples': self.samples,
+            'waits': self.waits,
+            'bdr_waits': self.bdr_waits,
+            'statements': None,
+            'bgwriter': None,
+            'wal': None,
+        }
+        if before['statements'] is not None \
+                and after['statements'] is not None:
+            statements = []
+            for (key, s) in after['statements'].items():
+                d = diff(before['statements'].get(key, {}), s)
+                if d.get('calls', 0) <= 0:
+                    continue
+                statements.append({
+                    'queryid': s['queryid'],
+                    'query': s['query'][:QUERY_LENGTH],
+                    'calls': d['calls'],
+                    'exec_time': exec_time(d),
+                    'rows': d.get('rows', 0),
+                })
+            statements.sort(key=lambda s: s['exec_time'], reverse=True)
+            profile['statements'] = statements[:TOP_DETAILS]
+        if before['bgwriter'] is not None and after['bgwriter'] is not None:
+            profile['bgwriter'] = diff(before['bgwriter'], after['bgwriter'])
+        if before['wal'] is not None and after['wal'] is not None:
+            profile['wal'] = diff(before['wal'], after['wal'])
+        return profile
+
+    def close(self):
+        self.conn.close()
+        self.sampling_conn.close()
+
+
+def wait_summary(waits, samples):
+    """
+    Returns the average number of active processes, the top wait events and
+    the main wait event if significant, of the sampled wait events
+    """
+    waits = sorted(waits.items(), key=lambda w: w[1], reverse=True)
+    active = sum(n for (_, n) in waits)
+    if active == 0:
+        return ('0.00' if samples > 0 else '', '', None)
+    top = '|'.join([
+        "%s=%.1f%%" % (event, 100.0 * n / active) for (event, n) in waits[:TOP]
+    ])
+    main = None
+    if float(waits[0][1]) / active >= BOTTLENECK_SHARE:
+        main = waits[0][0]
+    return ("%.2f" % (float(active) / samples), top, main)
+
+
+def summary(profile):
+    """
+    Returns the bottleneck summary of a node profile, as a dict of COLUMNS
+    """
+    s = dict.fromkeys(COLUMNS, '')
+    samples = profile['samples']
+    (s['active_sessions'], s['top_waits'], main) = \
+        wait_summary(profile['waits'], samples)
+    (s['bdr_active_workers'], s['bdr_top_waits'], bdr_main) = \
+        wait_summary(profile['bdr_waits'], samples)
+    if profile['statements']:
+        s['top_statements'] = '|'.join([
+            "%s=%.0fms" % (st['queryid'], st['exec_time'])
+            for st in profile['statements'][:TOP]
+        ])
+
+    pressure = []
+    bgwriter = profile['bgwriter']
+    if bgwriter is not None:
+        s['checkpoints_req'] = bgwriter.get('checkpoints_req', 0)
+        written = sum(
+            bgwriter.get(k, 0)
+            for k in ('buffers_checkpoint', 'buffers_clean', 'buffers_backend')
+        )
+        if written > 0:
+            backend = 100.0 * bgwriter.get('buffers_backend', 0) / written
+            s['buffers_backend_pct'] = "%.1f" % backend
+        if s['checkpoints_req'] > 0:
+            pressure.append('checkpoints_req')
+    wal = profile['wal']
+    if wal is not None and profile['elapsed'] > 0:
+        s['wal_mbps'] = "%.2f" % (
+            float(wal.get('wal_bytes', 0)) / 1024 ** 2 / profile['elapsed']
+        )
+        if wal.get('wal_records', 0) > 0:
+            s['wal_fpi_pct'] = "%.1f" % (
+                100.0 * wal.get('wal_fpi', 0) / wal['wal_records']
+            )
+        s['wal_buffers_full'] = wal.get('wal_buffers_full', 0)
+        if s['wal_buffers_full'] > 0:
+            pressure.append('wal_buffers_full')
+
+    # The main wait events of the client sessions and of the BDR workers, if
+    # significant, followed by the write pressure indicators
+    bottleneck = []
+    if main is not None:
+        bottleneck.append(main)
+    if bdr_main is not None:
+        bottleneck.append('bdr:%s' % bdr_main)
+    s['bottleneck'] = '+'.join(bottleneck + pressure)
+    return s
+
+
+class Profiler(object):
+    """
+    Profiles all the given nodes concurrently
+    """
+
+    def __init__(self, nodes, interval, directory=None):
+        self.directory = directory
+        self.nodes = [
+            NodeProfiler(node_name, dsn, interval)
+            for (node_name, dsn) in nodes
+        ]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.nodes))
+
+    def start(self):
+        for f in [self.executor.submit(n.start) for n in self.nodes]:
+            f.result()
+
+    def stop(self, terminal):
+        """
+        Stop the profiling of the step and returns its summary columns. The
+        detailed profile is saved in the profile directory, in a file named
+        after the end of the step and the number of terminals.
+        """
+        futures = [(n, self.executor.submit(n.stop)) for n in self.nodes]
+        profiles = {n.node_name: f.result() for (n, f) in futures}
+        if self.directory:
+            path = os.path.join(self.directory, 'profile-%s-t%d.json' % (
+                datetime.utcnow().strftime('%Y-%m-%dT%H%M%S.%f'), terminal
+            ))
+            with open(path, 'w') as f:
+                json.dump(profiles, f, indent=2, sort_keys=True)
+
+        data = {}
+        for n in self.nodes:
+            s = summary(profiles[n.node_name])
+            for c in COLUMNS:
+                data['%s_%s' % (n.node_name, c)] = s[c]
+        return data
+
+    def close(self):
+        self.executor.shutdown()
+        for n in self.nodes:
+            n.close()
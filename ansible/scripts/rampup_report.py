@@ -0,0 +1,505 @@
+"""
+Saturation report for the results of dbt2-driver-rampup.py
+
+The NOTPM vs terminals curve is fitted with the Universal Scalability Law:
+
+    X(N) = l * N / (1 + s * (N - 1) + k * N * (N - 1))
+
+where l is the throughput of one terminal, s the contention and k the
+coherency penalty. Two knees are searched:
+- the throughput knee: the number of terminals from which the marginal gain
+  of one more terminal, on the fitted curve, falls below --gain of the gain of
+  the first terminal
+- the replication knee: the first step where the sustainable NOTPM, the lowest
+  sustainable NOTPM of all the nodes, is more than --divergence below the
+  NOTPM
+
+The recommended operating point is the last measured step before the first
+knee. The report is a self-contained HTML file, with SVG charts: NOTPM,
+fitted curve and sustainable NOTPM per node, marginal gain per terminal.
+
+Results are read from the CSV output or from the journal of
+dbt2-driver-rampup.py.
+
+Ex:
+
+$ python3 ./rampup_report.py -o /tmp/report.html /tmp/rampup.csv
+"""
+
+import argparse
+import csv
+import html
+import json
+import math
+import sys
+
+
+# Charts size, in pixels
+WIDTH = 800
+HEIGHT = 400
+MARGIN = 60
+COLORS = (
+    '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b',
+    '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
+)
+
+
+def node_sustainable_notpm(data):
+    """
+    Returns the sustainable NOTPM of each node of a step, from the catchup
+    time or from the lag time series, following the objective of the run.
+    Per node results come with the node catchup time, or lag time series
+    statistics.
+    """
+    if data.get('objective') == 'series':
+        (suffix, marker) = ('_series_notpm', '%s_peak_lag_time')
+    else:
+        (suffix, marker) = ('_sustainable_notpm', '%s_catchup_time')
+    rates = {}
+    for (k, v) in data.items():
+        if not k.endswith(suffix) or v in (None, ''):
+            continue
+        node_name = k[:-len(suffix)]
+        if marker % node_name in data:
+            rates[node_name] = float(v)
+    return rates
+
+
+def read_results(path):
+    """
+    Returns the results of the steps of a dbt2-driver-rampup.py run, in the
+    order they were executed, from its CSV output or its journal. The
+    sustainable NOTPM of the cluster, the lowest sustainable NOTPM among the
+    nodes, is added when missing.
+    """
+    with open(path) as f:
+        content = f.read()
+    steps = []
+    if content.lstrip().startswith('{'):
+        for line in content.splitlines():
+            try:
+                steps.append(json.loads(line))
+            except ValueError:
+                # Partially written record
+                continue
+    else:
+        header = None
+        for row in csv.reader(
+                [line for line in content.splitlines() if line.strip()]):
+            if row[0] == 'timestamp':
+                # Headers are written again when the columns change
+                header = row
+            elif header is not None and len(row) == len(header):
+                steps.append(dict(zip(header, row)))
+
+    for data in steps:
+        if data.get('sustainable_notpm') in (None, ''):
+            rates = node_sustainable_notpm(data)
+            if rates:
+                data['sustainable_notpm'] = min(rates.values())
+    return steps
+
+
+def read_steps(path):
+    """
+    Returns the steps of a rampup run, sorted by number of terminals
+    """
+    results = {}
+    for data in read_results(path):
+        step = {
+            'terminals': int(data['terminals']),
+            'notpm': float(data['notpm']),
+            'sustainable': node_sustainable_notpm(data),
+        }
+        step['sustainable_notpm'] = float(
+            data.get('sustainable_notpm') or step['notpm']
+        )
+        # Steps measured again, after a resume, replace the previous ones
+        results[step['terminals']] = step
+    return [results[t] for t in sorted(results)]
+
+
+def solve(a, b):
+    """
+    Solve the linear system a.x = b, Gaussian elimination
+    """
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(n)]
+    for i in range(n):
+        p = max(range(i, n), key=lambda r: abs(m[r][i]))
+        if abs(m[p][i]) < 1e-300:
+            raise ValueError("Singular system")
+        (m[i], m[p]) = (m[p], m[i])
+        for r in range(i + 1, n):
+            f = m[r][i] / m[i][i]
+            for c in range(i, n + 1):
+                m[r][c] -= f * m[i][c]
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (m[i][n] - sum(m[i][c] * x[c] for c in range(i + 1, n))) \
+            / m[i][i]
+    return x
+
+
+def fit_usl(terminals, notpm):
+    """
+    Fit the Universal Scalability Law, returns (l, s, k). N/X(N) is a second
+    degree polynomial of N, fitted by least squares.
+    """
+    if len(terminals) < 3:
+        raise ValueError("At least 3 steps are needed")
+    rows = [[1.0, float(n), float(n) ** 2] for n in terminals]
+    y = [float(n) / x for (n, x) in zip(terminals, notpm)]
+    ata = [
+        [sum(r[i] * r[j] for r in rows) for j in range(3)] for i in range(3)
+    ]
+    aty = [sum(r[i] * v for (r, v) in zip(rows, y)) for i in range(3)]
+    (a, b, c) = solve(ata, aty)
+    if a + b + c <= 0:
+        raise ValueError("Unable to fit the throughput curve")
+    l = 1.0 / (a + b + c)
+    s = min(max(1.0 - a * l, 0.0), 1.0)
+    k = max(c * l, 0.0)
+    return (l, s, k)
+
+
+def usl(n, params):
+    (l, s, k) = params
+    return l * n / (1 + s * (n - 1) + k * n * (n - 1))
+
+
+def marginal_gain(n, params):
+    """
+    Throughput gained by adding one terminal to n terminals
+    """
+    return usl(n + 1, params) - usl(n, params)
+
+
+def throughput_knee(params, max_terminals, gain):
+    """
+    Returns the number of terminals from which the marginal gain is lower than
+    gain times the gain of the first terminal, or None
+    """
+    first = usl(1, params)
+    for n in range(1, max_terminals + 1):
+        if marginal_gain(n, params) < gain * first:
+            return n
+    return None
+
+
+def replication_knee(steps, divergence):
+    """
+    Returns the first step where the sustainable NOTPM diverges from the
+    NOTPM, or None
+    """
+    for step in steps:
+        if step['sustainable_notpm'] < (1 - divergence) * step['notpm']:
+            return step
+    return None
+
+
+def recommend(steps, knee):
+    """
+    Returns the last step before the knee, or the step with the highest
+    sustainable NOTPM if there is no knee
+    """
+    if knee is None:
+        return max(steps, key=lambda s: s['sustainable_notpm'])
+    before = [s for s in steps if s['terminals'] < knee]
+    return before[-1] if before else steps[0]
+
+
+def scale(values, size, reverse=False):
+    """
+    Returns a function mapping the range of values to [0, size]
+    """
+    lo = min(0, min(values))
+    hi = max(values)
+    if hi <= lo:
+        hi = lo + 1
+
+    def f(v):
+        r = (v - lo) / (hi - lo) * size
+        return size - r if reverse else r
+    return (f, lo, hi)
+
+
+def svg_chart(title, x_label, y_label, series, vlines=(), points=()):
+    """
+    Returns an SVG line chart. series is a list of (name, [(x, y)], dashed),
+    vlines a list of (x, label), points a list of (x, y, label).
+    """
+    w = WIDTH - 2 * MARGIN
+    h = HEIGHT - 2 * MARGIN
+    xs = [x for (_, data, _) in series for (x, _) in data]
+    ys = [y for (_, data, _) in series for (_, y) in data]
+    (fx, x_lo, x_hi) = scale(xs, w)
+    (fy, y_lo, y_hi) = scale(ys, h, reverse=True)
+
+    out = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+        'font-family="sans-serif" font-size="12">' % (WIDTH, HEIGHT),
+        '<text x="%d" y="20" font-size="16">%s</text>'
+        % (MARGIN, html.escape(title)),
+        '<g transform="translate(%d,%d)">' % (MARGIN, MARGIN),
+        '<rect width="%d" height="%d" fill="none" stroke="#ccc"/>' % (w, h),
+    ]
+    # Axis ticks
+    for i in range(6):
+        xv = x_lo + (x_hi - x_lo) * i / 5.0
+        yv = y_lo + (y_hi - y_lo) * i / 5.0
+        out.append(
+            '<text x="%.1f" y="%d" text-anchor="middle">%.0f</text>'
+            % (fx(xv), h + 15, xv)
+        )
+        out.append(
+            '<line x1="0" x2="%d" y1="%.1f" y2="%.1f" stroke="#eee"/>'
+            % (w, fy(yv), fy(yv))
+        )
+        out.append(
+            '<text x="-5" y="%.1f" text-anchor="end">%.0f</text>'
+            % (fy(yv) + 4, yv)
+        )
+    out.append(
+        '<text x="%d" y="%d" text-anchor="middle">%s</text>'
+        % (w / 2, h + 35, html.escape(x_label))
+    )
+    out.append(
+        '<text transform="translate(-50,%d) rotate(-90)" '
+        'text-anchor="middle">%s</text>' % (h / 2, html.escape(y_label))
+    )
+    for (x, label) in vlines:
+        out.append(
+            '<line x1="%.1f" x2="%.1f" y1="0" y2="%d" stroke="#d62728" '
+            'stroke-dasharray="4,4"/>' % (fx(x), fx(x), h)
+        )
+        out.append(
+            '<text x="%.1f" y="12" fill="#d62728">%s</text>'
+            % (fx(x) + 4, html.escape(label))
+        )
+    for (i, (name, data, dashed)) in enumerate(series):
+        color = COLORS[i % len(COLORS)]
+        out.append(
+            '<polyline fill="none" stroke="%s" stroke-width="2"%s '
+            'points="%s"/>' % (
+                color, ' stroke-dasharray="6,3"' if dashed else '',
+                ' '.join('%.1f,%.1f' % (fx(x), fy(y)) for (x, y) in data)
+            )
+        )
+        if not dashed:
+            for (x, y) in data:
+                out.append(
+                    '<circle cx="%.1f" cy="%.1f" r="3" fill="%s"/>'
+                    % (fx(x), fy(y), color)
+                )
+        # Legend
+        out.append(
+            '<rect x="%d" y="%d" width="10" height="10" fill="%s"/>'
+            % (w + 10 - MARGIN * 2, 10 + i * 16, color)
+        )
+        out.append(
+            '<text x="%d" y="%d" text-anchor="end">%s</text>'
+            % (w + 5 - MARGIN * 2, 19 + i * 16, html.escape(name))
+        )
+    for (x, y, label) in points:
+        out.append(
+            '<circle cx="%.1f" cy="%.1f" r="7" fill="none" stroke="#000" '
+            'stroke-width="2"/>' % (fx(x), fy(y))
+        )
+        out.append(
+            '<text x="%.1f" y="%.1f">%s</text>'
+            % (fx(x) + 10, fy(y) + 20, html.escape(label))
+        )
+    out.append('</g></svg>')
+    return '\n'.join(out)
+
+
+def report(steps, params, knees, best):
+    """
+    Returns the HTML report
+    """
+    terminals = [s['terminals'] for s in steps]
+    max_terminals = max(terminals)
+    curve = []
+    if params is not None:
+        n_points = min(max_terminals, 200)
+        curve = [
+            (n, usl(n, params))
+            for n in sorted(set(
+                max(1, int(round(i * max_terminals / float(n_points))))
+                for i in range(n_points + 1)
+            ))
+        ]
+    nodes = sorted(set(n for s in steps for n in s['sustainable']))
+
+    series = [
+        ('notpm', [(s['terminals'], s['notpm']) for s in steps], False),
+    ]
+    if curve:
+        series.append(('USL fit', curve, True))
+    series.append((
+        'sustainable',
+        [(s['terminals'], s['sustainable_notpm']) for s in steps], False
+    ))
+    for node in nodes:
+        series.append((
+            node,
+            [(s['terminals'], s['sustainable'][node]) for s in steps
+             if node in s['sustainable']],
+            True
+        ))
+    vlines = [(n, label) for (label, n) in knees if n is not None]
+    chart = svg_chart(
+        'NOTPM vs terminals', 'terminals', 'NOTPM', series, vlines,
+        [(best['terminals'], best['notpm'], 'recommended')]
+    )
+
+    gains = [(
+        'measured',
+        [
+            (b['terminals'], (b['notpm'] - a['notpm'])
+             / (b['terminals'] - a['terminals']))
+            for (a, b) in zip(steps, steps[1:])
+        ],
+        False
+    )]
+    if params is not None:
+        gains.append((
+            'USL fit', [(n, marginal_gain(n, params)) for (n, _) in curve],
+            True
+        ))
+    gain_chart = svg_chart(
+        'Marginal gain per terminal', 'terminals', 'NOTPM per terminal',
+        gains, vlines
+    )
+
+    summary = [
+        ('Recommended operating point', '%d terminals, %.0f NOTPM, '
+         '%.0f sustainable NOTPM' % (
+             best['terminals'], best['notpm'], best['sustainable_notpm'])),
+    ]
+    for (label, n) in knees:
+        summary.append((label, 'none' if n is None else '%d terminals' % n))
+    if params is not None:
+        (_, s, k) = params
+        summary.append(('USL parameters', 'l=%.2f, s=%.5f, k=%.7f' % params))
+        if k > 0:
+            summary.append((
+                'USL peak',
+                '%.0f terminals' % math.sqrt((1 - s) / k)
+            ))
+
+    header = ['terminals', 'notpm', 'sustainable_notpm'] + nodes
+    rows = [
+        [str(s['terminals']), '%.0f' % s['notpm'],
+         '%.0f' % s['sustainable_notpm']]
+        + ['%.0f' % s['sustainable'][n] if n in s['sustainable'] else ''
+           for n in nodes]
+        for s in steps
+    ]
+    return '\n'.join([
+        '<!DOCTYPE html>',
+        '<html><head><meta charset="utf-8"><title>Rampup report</title>',
+        '<style>body{font-family:sans-serif}table{border-collapse:collapse}'
+        'td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}'
+        '.best{background:#ffd}</style></head><body>',
+        '<h1>Rampup report</h1>',
+        '<table>',
+        '\n'.join(
+            '<tr><th>%s</th><td>%s</td></tr>'
+            % (html.escape(k), html.escape(v)) for (k, v) in summary
+        ),
+        '</table>',
+        chart,
+        gain_chart,
+        '<table><tr>%s</tr>' % ''.join(
+            '<th>%s</th>' % html.escape(h) for h in header
+        ),
+        '\n'.join(
+            '<tr%s>%s</tr>' % (
+                ' class="best"' if s is best else '',
+                ''.join('<td>%s</td>' % v for v in r)
+            ) for (s, r) in zip(steps, rows)
+        ),
+        '</table>',
+        '</body></html>',
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the saturation knee of dbt2-driver-rampup.py "
+                    "results and build an HTML report."
+    )
+    parser.add_argument(
+        'input',
+        type=str,
+        help="dbt2-driver-rampup.py CSV output or journal.",
+    )
+    parser.add_argument(
+        '--output', '-o',
+        dest='output',
+        type=str,
+        help="HTML report file. Default: %(default)s",
+        default='rampup-report.html',
+    )
+    parser.add_argument(
+        '--gain',
+        dest='gain',
+        type=float,
+        help="Throughput knee: ratio of the marginal gain of one terminal to "
+             "the gain of the first terminal. Default: %(default)s",
+        default=0.5,
+    )
+    parser.add_argument(
+        '--divergence',
+        dest='divergence',
+        type=float,
+        help="Replication knee: ratio of the NOTPM the sustainable NOTPM can "
+             "be below. Default: %(default)s",
+        default=0.05,
+    )
+    env = parser.parse_args()
+
+    try:
+        steps = read_steps(env.input)
+    except (OSError, ValueError, KeyError) as e:
+        sys.exit("Unable to read the results: %s" % e)
+    if not steps:
+        sys.exit("No result found")
+
+    try:
+        params = fit_usl(
+            [s['terminals'] for s in steps], [s['notpm'] for s in steps]
+        )
+    except (ValueError, ZeroDivisionError) as e:
+        print("Unable to fit the USL model: %s" % e, file=sys.stderr)
+        params = None
+
+    knee = None
+    if params is not None:
+        knee = throughput_knee(
+            params, max(s['terminals'] for s in steps), env.gain
+        )
+    replication = replication_knee(steps, env.divergence)
+    knees = [
+        ('Throughput knee', knee),
+        ('Replication knee',
+         replication['terminals'] if replication else None),
+    ]
+    found = [n for (_, n) in knees if n is not None]
+    best = recommend(steps, min(found) if found else None)
+
+    with open(env.output, 'w') as f:
+        f.write(report(steps, params, knees, best))
+
+    print("terminals,notpm,sustainable_notpm,throughput_knee,replication_knee")
+    print("%d,%.2f,%.2f,%s,%s" % (
+        best['terminals'], best['notpm'], best['sustainable_notpm'],
+        '' if knees[0][1] is None else knees[0][1],
+        '' if knees[1][1] is None else knees[1][1],
+    ))
+
+
+if __name__ == "__main__":
+    main()
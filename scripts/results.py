@@ -0,0 +1,481 @@
+# coding: utf-8
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import yaml
+
+# The rampup results reader is shared with the saturation report
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'ansible', 'scripts'
+))
+from rampup_report import read_results  # noqa: E402
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    label TEXT,
+    imported_at TEXT NOT NULL,
+    source TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    configuration TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    terminals INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (run_id, step)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL NOT NULL,
+    FOREIGN KEY (run_id, step) REFERENCES steps(run_id, step)
+        ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS metrics_run_name ON metrics (run_id, name);
+"""
+
+# configuration.yml variables identifying a run configuration
+CONFIGURATION_KEYS = (
+    'pg_type', 'pg_version', 'bdr_writers', 'bdr_wal_decoder',
+    'dbt2_warehouse',
+)
+
+# Compared metrics, by kind of run: True when higher is better
+METRICS = {
+    'rampup': [
+        ('notpm', True),
+        ('sustainable_notpm', True),
+        ('new_order_p90', False),
+        ('new_order_p99', False),
+        ('payment_p90', False),
+        ('payment_p99', False),
+    ],
+    'downtime': [
+        ('downtime', False),
+        ('window_duration', False),
+    ],
+}
+# Metric whose samples are the durations of the unavailability windows of
+# the downtime runs
+WINDOW_DURATION = 'window_duration'
+
+
+# Two-sided 95% critical values of Student's t distribution, by degrees of
+# freedom. Missing degrees of freedom use the next lower value.
+T_95 = [
+    (1, 12.706), (2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571),
+    (6, 2.447), (7, 2.365), (8, 2.306), (9, 2.262), (10, 2.228),
+    (12, 2.179), (15, 2.131), (20, 2.086), (30, 2.042), (60, 2.000),
+    (120, 1.980),
+]
+
+
+def load_yaml(file_path):
+    # Load yaml file
+    if not os.path.exists(file_path):
+        sys.exit("ERROR: file %s not found" % file_path)
+    try:
+        with open(file_path) as f:
+            return yaml.load(f.read(), Loader=yaml.CLoader)
+    except Exception as e:
+        sys.exit("ERROR: could not read file %s (%s)" % (file_path, e))
+
+
+def fingerprint(configuration_path, infra_path):
+    """
+    Returns the configuration of a run and its fingerprint: BDR and Postgres
+    settings from configuration.yml, instance types and volumes from the
+    infrastructure file.
+    """
+    configuration = load_yaml(configuration_path)
+    infra = load_yaml(infra_path)
+    c = {k: configuration.get(k) for k in CONFIGURATION_KEYS}
+    c['cluster_name'] = infra.get('cluster_name')
+    c['machines'] = {
+        name: {
+            'instance_type': m.get('instance_type'),
+            'volume': m.get('volume'),
+            'additional_volumes': m.get('additional_volumes'),
+        }
+        for (name, m) in infra.get('machines', {}).items()
+    }
+    digest = hashlib.sha1(
+        json.dumps(c, sort_keys=True).encode('utf-8')
+    ).hexdigest()[:12]
+    return (c, digest)
+
+
+def to_float(value):
+    try:
+        v = float(value)
+    except (TypeError, ValueError):
+        return None
+    return v if math.isfinite(v) else None
+
+
+def read_rampup(path):
+    """
+    Returns the steps of a dbt2-driver-rampup.py run, from its CSV output or
+    its journal
+    """
+    return read_results(path)
+
+
+def read_downtime(path):
+    """
+    Returns the result of a downtime-checker.py run, from its JSON output, as
+    one step
+    """
+    with open(path) as f:
+        return [json.load(f)]
+
+
+class Store(object):
+    """
+    SQLite results database
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(SCHEMA)
+
+    def add_run(self, kind, label, source, configuration, digest, steps):
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO runs (kind, label, imported_at, source, "
+                "fingerprint, configuration) VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, label, datetime.utcnow().isoformat(), source, digest,
+                 json.dumps(configuration, sort_keys=True))
+            )
+            run_id = cur.lastrowid
+            for (i, data) in enumerate(steps):
+                terminals = data.get('terminals')
+                self.conn.execute(
+                    "INSERT INTO steps VALUES (?, ?, ?, ?)",
+                    (run_id, i,
+                     int(terminals) if terminals not in (None, '') else None,
+                     json.dumps(data))
+                )
+                self.conn.executemany(
+                    "INSERT INTO metrics VALUES (?, ?, ?, ?)",
+                    [
+                        (run_id, i, k, to_float(v)) for (k, v) in data.items()
+                        if k != 'terminals' and to_float(v) is not None
+                    ]
+                )
+        return run_id
+
+    def runs(self):
+        return self.conn.execute(
+            "SELECT r.id, r.kind, r.label, r.imported_at, r.fingerprint, "
+            "COUNT(s.step) FROM runs r LEFT JOIN steps s ON s.run_id = r.id "
+            "GROUP BY r.id ORDER BY r.id"
+        ).fetchall()
+
+    def run(self, run_id):
+        r = self.conn.execute(
+            "SELECT kind, fingerprint, configuration FROM runs WHERE id = ?",
+            (run_id,)
+        ).fetchone()
+        if r is None:
+            sys.exit("ERROR: run %s not found" % run_id)
+        return (r[0], r[1], json.loads(r[2]))
+
+    def values(self, run_id, name):
+        """
+        Returns the values of a metric of a run, by number of terminals
+        """
+        if name == WINDOW_DURATION:
+            return [
+                (None, w['duration'])
+                for (data,) in self.conn.execute(
+                    "SELECT data FROM steps WHERE run_id = ?", (run_id,)
+                )
+                for w in json.loads(data).get('windows', [])
+            ]
+        return self.conn.execute(
+            "SELECT s.terminals, m.value FROM metrics m JOIN steps s "
+            "ON s.run_id = m.run_id AND s.step = m.step "
+            "WHERE m.run_id = ? AND m.name = ? ORDER BY s.step",
+            (run_id, name)
+        ).fetchall()
+
+    def delete(self, run_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+
+
+def t_critical(df):
+    value = T_95[0][1]
+    for (d, t) in T_95:
+        if d > df:
+            break
+        value = t
+    return value if df < 1000 else 1.96
+
+
+def mean_ci(values):
+    """
+    Returns the mean and the half width of its 95% confidence interval
+    """
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return (mean, None)
+    sd = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    return (mean, t_critical(n - 1) * sd / math.sqrt(n))
+
+
+def group_values(store, run_ids, name):
+    """
+    Returns the values of a metric of a group of runs, by number of terminals
+    """
+    values = {}
+    for run_id in run_ids:
+        for (terminals, v) in store.values(run_id, name):
+            values.setdefault(terminals, []).append(v)
+    return values
+
+
+def compare_metric(store, baseline, candidate, name, higher_is_better,
+                   threshold):
+    """
+    Compares a metric between two groups of runs. Returns (relative change
+    in %, half width of its 95% confidence interval, number of compared
+    values, verdict), or None when there is nothing to compare.
+
+    Rampup runs are compared step by step, matching the number of terminals:
+    the relative changes of the steps are the samples. Runs without steps,
+    like downtime runs, are compared run by run (Welch's t-test).
+    """
+    a = group_values(store, baseline, name)
+    b = group_values(store, candidate, name)
+    common = [t for t in a if t in b and t is not None]
+    if common:
+        changes = []
+        for t in common:
+            ma = sum(a[t]) / len(a[t])
+            mb = sum(b[t]) / len(b[t])
+            if ma != 0:
+                changes.append(100.0 * (mb - ma) / abs(ma))
+        if not changes:
+            return None
+        (change, ci) = mean_ci(changes)
+        n = len(changes)
+    elif None in a and None in b:
+        (ma, ca) = mean_ci(a[None])
+        (mb, cb) = mean_ci(b[None])
+        if ma == 0:
+            return None
+        change = 100.0 * (mb - ma) / abs(ma)
+        ci = None
+        if ca is not None and cb is not None:
+            # Welch's t-test: confidence interval of the difference
+            (na, nb) = (len(a[None]), len(b[None]))
+            va = (ca / t_critical(na - 1)) ** 2
+            vb = (cb / t_critical(nb - 1)) ** 2
+            se = math.sqrt(va + vb)
+            if se > 0:
+                df = (va + vb) ** 2 / (
+                    va ** 2 / (na - 1) + vb ** 2 / (nb - 1)
+                )
+            else:
+                df = na + nb - 2
+            ci = 100.0 * t_critical(int(df)) * se / abs(ma)
+        n = min(len(a[None]), len(b[None]))
+    else:
+        return None
+
+    worse = -change if higher_is_better else change
+    # A change is significant when its confidence interval does not contain
+    # zero. Without confidence interval, a change above the threshold can't
+    # be qualified.
+    if abs(change) <= threshold:
+        verdict = 'ok'
+    elif ci is None:
+        verdict = 'insufficient data'
+    elif abs(change) <= ci:
+        verdict = 'ok'
+    elif worse > 0:
+        verdict = 'REGRESSION'
+    else:
+        verdict = 'improvement'
+    return (change, ci, n, verdict)
+
+
+def cmd_import(env, kind):
+    (configuration, digest) = fingerprint(env.configuration, env.infra)
+    try:
+        if kind == 'rampup':
+            steps = read_rampup(env.input)
+        else:
+            steps = read_downtime(env.input)
+    except (OSError, ValueError) as e:
+        sys.exit("ERROR: could not read file %s (%s)" % (env.input, e))
+    if not steps:
+        sys.exit("ERROR: no result found in %s" % env.input)
+    store = Store(env.database)
+    run_id = store.add_run(
+        kind, env.label, os.path.abspath(env.input), configuration, digest,
+        steps
+    )
+    print("Run %s imported: %s, %d steps, fingerprint %s"
+          % (run_id, kind, len(steps), digest))
+
+
+def cmd_list(env):
+    store = Store(env.database)
+    print("id,kind,label,imported_at,fingerprint,steps")
+    for r in store.runs():
+        print(','.join(['' if v is None else str(v) for v in r]))
+
+
+def cmd_delete(env):
+    Store(env.database).delete(env.run_id)
+
+
+def cmd_compare(env):
+    store = Store(env.database)
+    kinds = set()
+    configurations = {}
+    for run_id in env.baseline + env.candidate:
+        (kind, digest, configuration) = store.run(run_id)
+        kinds.add(kind)
+        configurations[digest] = configuration
+    if len(kinds) != 1:
+        sys.exit("ERROR: cannot compare runs of different kinds")
+    kind = kinds.pop()
+
+    # Configuration differences between the compared runs
+    if len(configurations) > 1:
+        confs = list(configurations.items())
+        keys = sorted(set().union(*[c for (_, c) in confs]))
+        for k in keys:
+            values = [json.dumps(c.get(k), sort_keys=True) for (_, c) in confs]
+            if len(set(values)) > 1:
+                print("# %s: %s" % (k, ' / '.join(
+                    "%s=%s" % (d, v) for ((d, _), v) in zip(confs, values)
+                )), file=sys.stderr)
+
+    regressions = 0
+    print("metric,change_pct,ci95_pct,samples,verdict")
+    for (name, higher_is_better) in METRICS[kind]:
+        r = compare_metric(
+            store, env.baseline, env.candidate, name, higher_is_better,
+            env.threshold
+        )
+        if r is None:
+            continue
+        (change, ci, n, verdict) = r
+        print("%s,%.2f,%s,%d,%s" % (
+            name, change, '' if ci is None else "%.2f" % ci, n, verdict
+        ))
+        if verdict == 'REGRESSION':
+            regressions += 1
+    # Non zero exit code on regression, to be used as a gate
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--database', '-d',
+        dest='database',
+        type=str,
+        default='results.db',
+        help="SQLite results database path. Default: %(default)s",
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    for kind in ('rampup', 'downtime'):
+        p = subparsers.add_parser(
+            'import-%s' % kind,
+            help="Import the results of a %s run." % kind,
+        )
+        p.set_defaults(kind=kind)
+        p.add_argument(
+            'input',
+            metavar='RESULTS_PATH',
+            type=str,
+            help=(
+                "dbt2-driver-rampup.py CSV output or journal."
+                if kind == 'rampup'
+                else "downtime-checker.py JSON output."
+            ),
+        )
+        p.add_argument(
+            '--configuration', '-c',
+            dest='configuration',
+            required=True,
+            help="configuration.yml path used for the run.",
+        )
+        p.add_argument(
+            '--infra', '-i',
+            dest='infra',
+            required=True,
+            help="Infrastructure (YAML format) file path used for the run.",
+        )
+        p.add_argument(
+            '--label', '-l',
+            dest='label',
+            help="Run label.",
+        )
+
+    subparsers.add_parser('list', help="List the runs.")
+
+    p = subparsers.add_parser('delete', help="Delete a run.")
+    p.add_argument('run_id', metavar='RUN_ID', type=int, help="Run id.")
+
+    p = subparsers.add_parser(
+        'compare',
+        help="Compare runs and flag the regressions.",
+    )
+    p.add_argument(
+        '--baseline', '-b',
+        dest='baseline',
+        type=int,
+        nargs='+',
+        required=True,
+        help="Baseline run ids.",
+    )
+    p.add_argument(
+        '--candidate', '-n',
+        dest='candidate',
+        type=int,
+        nargs='+',
+        required=True,
+        help="Candidate run ids.",
+    )
+    p.add_argument(
+        '--threshold', '-t',
+        dest='threshold',
+        type=float,
+        default=5.0,
+        help="Relative change, in %%, above which a significant change is "
+             "flagged. Default: %(default)s",
+    )
+    env = parser.parse_args()
+
+    if env.command.startswith('import-'):
+        cmd_import(env, env.kind)
+    elif env.command == 'list':
+        cmd_list(env)
+    elif env.command == 'delete':
+        cmd_delete(env)
+    elif env.command == 'compare':
+        cmd_compare(env)